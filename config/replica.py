@@ -0,0 +1,116 @@
+# replica.py
+# This file contains the read/write splitting of the database. Read-only
+# routes take their session from get_read_db or get_async_read_db, which use
+# the replica engine when SQLALCHEMY_REPLICA_URL is set. Writes mark their
+# scope ("catalog", "orders"); reads of that scope stay on the primary for
+# REPLICA_MAX_LAG seconds so clients read their own writes. A replica that
+# cannot be reached is skipped for REPLICA_RETRY_SECONDS.
+
+import time
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from . import settings
+
+
+class ReplicaRouter:
+    # primary, replica, async_primary and async_replica return the
+    # sessionmaker to use, so engines are only created when a session is.
+
+    def __init__(self, primary, replica, async_primary, async_replica,
+                 max_lag: float, retry_seconds: float):
+        self.primary = primary
+        self.replica = replica
+        self.async_primary = async_primary
+        self.async_replica = async_replica
+        self.max_lag = max_lag
+        self.retry_seconds = retry_seconds
+        self._writes = {}
+        self._down_until = 0.0
+
+    def mark_write(self, scope: str):
+        self._writes[scope] = time.monotonic()
+
+    def mark_down(self):
+        self._down_until = time.monotonic() + self.retry_seconds
+
+    def use_replica(self, scope: str):
+        now = time.monotonic()
+        return (now >= self._down_until and
+                now - self._writes.get(scope, -self.max_lag) >= self.max_lag)
+
+    def session(self, scope: str):
+        if self.replica is not None and self.use_replica(scope):
+            db = self.replica()()
+            try:
+                # Checks out a connection now, so an unreachable replica
+                # falls back to the primary before the route runs.
+                db.connection()
+                return db
+            except DBAPIError:
+                db.close()
+                self.mark_down()
+        return self.primary()()
+
+    async def async_session(self, scope: str):
+        if self.async_replica is not None and self.use_replica(scope):
+            db = self.async_replica()()
+            try:
+                await db.connection()
+                return db
+            except DBAPIError:
+                await db.close()
+                self.mark_down()
+        return self.async_primary()()
+
+
+@settings.lazy
+def get_replica_sessionmaker():
+    return sessionmaker(
+        autocommit=False, autoflush=False,
+        bind=settings.make_engine(settings.SQLALCHEMY_REPLICA_URL,
+                                  "replica_engine"))
+
+
+@settings.lazy
+def get_async_replica_sessionmaker():
+    return sessionmaker(
+        bind=settings.make_async_engine(settings.ASYNC_SQLALCHEMY_REPLICA_URL,
+                                        "async_replica_engine"),
+        class_=AsyncSession, autocommit=False, autoflush=False,
+        expire_on_commit=False)
+
+
+has_replica = bool(settings.SQLALCHEMY_REPLICA_URL)
+replica_router = ReplicaRouter(
+    settings.get_sessionmaker,
+    get_replica_sessionmaker if has_replica else None,
+    settings.get_async_sessionmaker,
+    get_async_replica_sessionmaker if has_replica else None,
+    settings.REPLICA_MAX_LAG, settings.REPLICA_RETRY_SECONDS)
+
+
+def get_read_db():
+    db = replica_router.session("catalog")
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db():
+    db = await replica_router.async_session("catalog")
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_async_orders_read_db():
+    db = await replica_router.async_session("orders")
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -2,10 +2,14 @@
 # This file contains the settings for the project. It contains the settings for
 # the server, the database, the apps, ....
 
+import functools
 import os
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,28 +17,244 @@ load_dotenv()
 HOST = os.getenv("HOST", "127.0.0.1")
 PORT = int(os.getenv("PORT", "8000"))
 
+# Production server (runserver --prod): worker processes, seconds an idle
+# keep-alive connection is held open and the socket's pending connection
+# queue.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", os.cpu_count() or 1))
+KEEP_ALIVE_TIMEOUT = int(os.getenv("KEEP_ALIVE_TIMEOUT", 5))
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+
 SECRET_KEY = os.getenv(
     "SECRET_KEY",
     "f2b4f383950f83f86b87562835f682d40ec1e75a8ddc135f9b4d586da9aa36d6")
 
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 14))
+
+# In-memory denylist of logged out tokens: how often each worker pulls new
+# entries from the database and purges expired ones (seconds), and how many
+# entries its Bloom filter is sized for.
+DENYLIST_REFRESH_SECONDS = float(os.getenv("DENYLIST_REFRESH_SECONDS", 5))
+DENYLIST_PURGE_SECONDS = float(os.getenv("DENYLIST_PURGE_SECONDS", 3600))
+DENYLIST_CAPACITY = int(os.getenv("DENYLIST_CAPACITY", 100000))
+# Each pull re-reads entries created this many seconds before the newest one
+# already seen, so a logout whose transaction committed late is still picked
+# up. It must exceed the longest logout transaction plus worker clock skew.
+DENYLIST_OVERLAP_SECONDS = float(os.getenv("DENYLIST_OVERLAP_SECONDS", 30))
+
+# Cache of verified tokens -> user principal: maximum number of entries and
+# their lifetime in seconds, never beyond the token's own expiry. Logout is
+# seen by every worker through the denylist, but revoke_tokens, update_user
+# and delete_user only clear the cache of the worker that handled them: other
+# workers keep accepting the old principal for up to PRINCIPAL_CACHE_TTL.
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+# bcrypt runs on a dedicated thread pool of this many workers; beyond
+# PASSWORD_HASH_QUEUE pending hashes, new logins get 503 instead of queueing.
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 64))
+
+# Default and maximum number of rows returned by one page of a listing.
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+
+# Number of rows written per transaction by bulk endpoints.
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 5000))
+
+# In-process catalog cache: maximum number of entries and their lifetime in
+# seconds. The lifetime bounds how long other workers may serve stale rows.
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 10000))
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", 60))
+# Listing pages are cached apart from products, and only the first page of
+# each listing (no cursor), so walking a large catalog cannot fill memory.
+# Each entry holds up to MAX_PAGE_SIZE rows.
+CATALOG_PAGE_CACHE_SIZE = int(os.getenv("CATALOG_PAGE_CACHE_SIZE", 16))
+
+# Connection pool of each engine: connections kept open, extra connections
+# allowed under load, seconds to wait for one, seconds before a connection is
+# replaced and whether it is tested before use.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING",
+                             "true").lower() in ("1", "true", "yes")
+
+# Pragmas applied to every SQLite connection: write-ahead journal so readers
+# do not block on writers, the fsync level of commits, milliseconds to wait
+# for a lock before failing and bytes of the file memory-mapped.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))
+
+
+def engine_options(url: str, poolclass):
+    # SQLite files get a queue pool too, so a connection and its pragmas are
+    # reused instead of opened for every session. In-memory databases keep
+    # SQLAlchemy's default single-connection pool.
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if url.startswith("sqlite"):
+        if ":memory:" in url or url.split("://", 1)[-1] in ("", "/"):
+            return options
+        options["poolclass"] = poolclass
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                   pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def pool_stats(engine):
+    pool = getattr(engine, "sync_engine", engine).pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(), overflow=pool.overflow())
+    return stats
+
+
+# Engines are created on first use rather than at import, so CLI commands
+# and starting workers skip the driver import and pool setup until a request
+# needs them. make_engine and make_async_engine record them here by name.
+engines = {}
+_lazy_lock = threading.RLock()
+
+
+def lazy(function):
+    # Runs function once, on the first call, and returns its result after.
+    result = []
+
+    @functools.wraps(function)
+    def wrapper():
+        if not result:
+            with _lazy_lock:
+                if not result:
+                    result.append(function())
+        return result[0]
+
+    return wrapper
+
+
+def make_engine(url: str, name: str):
+    connect_args = {}
+    if url.startswith("sqlite"):
+        connect_args["check_same_thread"] = False
+    engine = create_engine(url, connect_args=connect_args,
+                           **engine_options(url, QueuePool))
+    if url.startswith("sqlite"):
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    engines[name] = engine
+    return engine
+
+
+# Async engines use the async driver of the same database: aiosqlite for
+# SQLite, asyncpg for Postgres. Async routes take an AsyncSession from
+# get_async_db and run the model helpers on it with run_in_session.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg"
+}
+
+
+def async_database_url(url: str):
+    scheme, _, address = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{address}"
+
+
+def make_async_engine(url: str, name: str):
+    engine = create_async_engine(url,
+                                 **engine_options(url, AsyncAdaptedQueuePool))
+    if url.startswith("sqlite"):
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    engines[name] = engine
+    return engine
+
 
 SQLALCHEMY_DATABASE_URL = os.getenv(
     "SQLALCHEMY_DATABASE_URL", "sqlite:///./sql_app.db")
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv(
+    "ASYNC_SQLALCHEMY_DATABASE_URL",
+    async_database_url(SQLALCHEMY_DATABASE_URL))
+
+
+@lazy
+def get_engine():
+    return make_engine(SQLALCHEMY_DATABASE_URL, "engine")
+
+
+@lazy
+def get_async_engine():
+    return make_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, "async_engine")
+
+
+@lazy
+def get_sessionmaker():
+    return sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+
+
+@lazy
+def get_async_sessionmaker():
+    # Objects stay loaded after commit: an expired attribute would need a
+    # lazy load, which async code outside run_in_session cannot do.
+    return sessionmaker(bind=get_async_engine(), class_=AsyncSession,
+                        autocommit=False, autoflush=False,
+                        expire_on_commit=False)
+
+
+def __getattr__(name: str):
+    # engine, async_engine, SessionLocal and AsyncSessionLocal remain
+    # available as attributes; reading one creates it.
+    factories = {
+        "engine": get_engine,
+        "async_engine": get_async_engine,
+        "SessionLocal": get_sessionmaker,
+        "AsyncSessionLocal": get_async_sessionmaker
+    }
+    if name in factories:
+        return factories[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Optional read replica for read-only routes (see config/replica.py). Reads
+# return to the primary for REPLICA_MAX_LAG seconds after a write of the same
+# kind, and for REPLICA_RETRY_SECONDS after the replica could not be reached.
+SQLALCHEMY_REPLICA_URL = os.getenv("SQLALCHEMY_REPLICA_URL")
+ASYNC_SQLALCHEMY_REPLICA_URL = os.getenv(
+    "ASYNC_SQLALCHEMY_REPLICA_URL",
+    SQLALCHEMY_REPLICA_URL and async_database_url(SQLALCHEMY_REPLICA_URL))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", 30))
 
 Base = declarative_base()
 
 def get_db():
-    db = SessionLocal()
+    db = get_sessionmaker()()
     try:
         yield db
     finally:
         db.close()
 
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+async def run_in_session(db: AsyncSession, function, *args, **kwargs):
+    # Runs a model helper written against Session on the AsyncSession. The
+    # helper's queries are awaited on the event loop through the async driver
+    # instead of blocking it or taking a threadpool slot.
+    return await db.run_sync(
+        lambda session: function(*args, db=session, **kwargs))
+
 INSTALLED_APPS = [
     # Local apps
     "user",
@@ -2,8 +2,9 @@ import pytest
 from main import app
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from config import settings
+from config import replica, settings
 
 @pytest.fixture(scope="module", autouse=True)
 def client():
@@ -20,7 +21,22 @@ def client():
         finally:
             db.close()
 
+    async_engine = create_async_engine("sqlite+aiosqlite:///./sql_test.db")
+    AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession,
+                                     autocommit=False, autoflush=False,
+                                     expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
     app.dependency_overrides[settings.get_db] = override_get_db
+    app.dependency_overrides[settings.get_async_db] = override_get_async_db
+    # The test database also serves as the replica.
+    app.dependency_overrides[replica.get_read_db] = override_get_db
+    app.dependency_overrides[replica.get_async_read_db] = override_get_async_db
+    app.dependency_overrides[
+        replica.get_async_orders_read_db] = override_get_async_db
         
     client = TestClient(app)
     return client
\ No newline at end of file
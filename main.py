@@ -2,29 +2,107 @@
 # This is the main file for the project. It contains the main loop and the
 # functions that are called from the main loop. It also contains the
 # functions that are called from the other files.
+#
+# The app is built by create_app, which imports the routers of the installed
+# apps. "main:app" still works: the app is created on first access.
+
+import importlib
 
 import fastapi
-from commands import Manage
-from config.settings import INSTALLED_APPS, Base, engine
+from config.settings import (INSTALLED_APPS, Base, engines, get_engine,
+                             pool_stats)
 
 description = """
 Simple shopping cart application built with FastAPI.
 """
 
-app = fastapi.FastAPI(
-    title="Shopping Cart", description=description, version="0.0.1",
-    contact={
-        "name": "Ali Kamali Ardakani",
-        "email": "aliardakani78@gmail.com",
+router = fastapi.APIRouter(tags=["database"])
+
+
+async def dispose_engines():
+    # Closes pooled connections once in-flight requests are done.
+    for engine in list(engines.values()):
+        if hasattr(engine, "sync_engine"):
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+@router.get(
+    "/pool-stats",
+    summary="Database connection pool statistics",
+    responses={
+        200: {
+            "description": "Pool class and connection counters of each "
+            "engine created so far",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "engine": {
+                            "pool": "QueuePool",
+                            "size": 5,
+                            "checked_in": 2,
+                            "checked_out": 1,
+                            "overflow": -2
+                        },
+                        "async_engine": {
+                            "pool": "AsyncAdaptedQueuePool",
+                            "size": 5,
+                            "checked_in": 1,
+                            "checked_out": 0,
+                            "overflow": -4
+                        }
+                    }
+                }
+            }
+        },
+        401: {
+            "description": "Unauthorized",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Not authenticated"
+                    }
+                }
+            }
+        },
     },
-)
+    )
+def database_pool_stats():
+    # Engines not created yet are left out rather than created here.
+    return {name: pool_stats(engine) for name, engine in engines.items()}
 
-for app_name in INSTALLED_APPS:
-    app.include_router(
-        __import__(app_name + ".urls").urls.router
+
+def create_app():
+    app = fastapi.FastAPI(
+        title="Shopping Cart", description=description, version="0.0.1",
+        contact={
+            "name": "Ali Kamali Ardakani",
+            "email": "aliardakani78@gmail.com",
+        },
     )
-    
+    for app_name in INSTALLED_APPS:
+        app.include_router(importlib.import_module(app_name + ".urls").router)
+    # Imported here so "import main" does not load the user app.
+    from user.views import get_current_active_user
+    app.include_router(
+        router, dependencies=[fastapi.Depends(get_current_active_user)])
+    app.add_event_handler("shutdown", dispose_engines)
+    return app
+
+
+def __getattr__(name: str):
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
-    Base.metadata.create_all(bind=engine)
+    from commands import Manage
+    # Registers the tables of every installed app before creating them.
+    for app_name in INSTALLED_APPS:
+        importlib.import_module(app_name + ".models")
+    Base.metadata.create_all(bind=get_engine())
     Manage.manage()
-    
\ No newline at end of file
@@ -0,0 +1,70 @@
+# benchmark.py
+# This file compares the two ways of serving a product listing: loading ORM
+# objects and running them through jsonable_encoder, as FastAPI does for the
+# returned value, against the Core select and FastJSONResponse path.
+#
+# Run it with: python -m product.benchmark [rows ...]
+
+import json
+import sys
+import time
+
+from config.settings import Base
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from user import models as user_models  # noqa: F401 (foreign key targets)
+
+from .models import Product
+from .responses import FastJSONResponse, orjson
+
+SIZES = [1000, 10000, 100000]
+
+
+def orm_path(db, rows):
+    products = db.query(Product).order_by(Product.id).limit(rows).all()
+    body = json.dumps(jsonable_encoder(products), ensure_ascii=False,
+                      allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+    db.expunge_all()
+    return body
+
+
+def fast_path(db, rows):
+    products, _ = Product.get_products_page(db, rows)
+    return FastJSONResponse(products).body
+
+
+def best_of(function, *args, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(sizes):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.execute(insert(Product.__table__), [{
+        "name": f"Product {i}",
+        "name_key": f"product {i}",
+        "price": i / 100,
+        "is_active": i % 10 != 0
+    } for i in range(max(sizes))])
+    db.commit()
+
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'rows':>8} {'orm (s)':>10} {'fast (s)':>10} {'speedup':>8}")
+    for rows in sizes:
+        assert len(json.loads(orm_path(db, rows))) == len(
+            json.loads(fast_path(db, rows)))
+        orm = best_of(orm_path, db, rows)
+        fast = best_of(fast_path, db, rows)
+        print(f"{rows:>8} {orm:>10.4f} {fast:>10.4f} {orm / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or SIZES)
@@ -0,0 +1,40 @@
+# cache.py
+# This file contains the catalog cache of the product app. Products are cached
+# as plain dicts keyed by id and by normalized name, along with the catalog
+# version. First listing pages have their own small cache. Product writes
+# invalidate the affected entries.
+
+from config.cache import TTLCache
+from config.settings import (CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL,
+                             CATALOG_PAGE_CACHE_SIZE)
+
+catalog_cache = TTLCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+page_cache = TTLCache(CATALOG_PAGE_CACHE_SIZE, CATALOG_CACHE_TTL)
+
+
+def name_key(name: str):
+    return ("name", name.lower())
+
+
+def id_key(id: int):
+    return ("id", id)
+
+
+def page_key(limit: int, active_only: bool):
+    return ("page", limit, active_only)
+
+
+def version_key():
+    return ("version",)
+
+
+def cache_product(product: dict):
+    catalog_cache.set(id_key(product["id"]), product)
+    catalog_cache.set(name_key(product["name"]), product)
+
+
+def invalidate_product(id: int, name: str):
+    catalog_cache.pop(id_key(id))
+    catalog_cache.pop(name_key(name))
+    catalog_cache.pop(version_key())
+    page_cache.clear()
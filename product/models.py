@@ -1,7 +1,61 @@
-from config.settings import Base
+from datetime import datetime
+from types import SimpleNamespace
+
+from config.replica import replica_router
+from config.settings import Base, PAGE_SIZE
 from fastapi.exceptions import HTTPException
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Integer, String,
+                        Float, Index, UniqueConstraint, bindparam, func,
+                        insert, literal, or_, select, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, relationship, validates
+
+from .cache import (cache_product, catalog_cache, id_key, invalidate_product,
+                    name_key, page_cache, page_key, version_key)
+
+
+def upsert(table, rows: list[dict], index_elements: list, set_, db: Session):
+    # INSERT ... ON CONFLICT DO UPDATE on SQLite and Postgres, executed once
+    # for all rows. set_ receives the "excluded" row and returns the columns
+    # to update on conflict.
+    dialects = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+    dialect_insert = dialects.get(db.get_bind().dialect.name)
+    if dialect_insert is None:
+        # Portable fallback: update the conflicting row, insert if none.
+        for values in rows:
+            excluded = SimpleNamespace(
+                **{column: literal(value) for column, value in values.items()})
+            where = [
+                table.c[column] == values[column] for column in index_elements
+            ]
+            updated = db.execute(
+                update(table).where(*where).values(set_(excluded))).rowcount
+            if not updated:
+                db.execute(insert(table).values(**values))
+        return
+    statement = dialect_insert(table)
+    db.execute(
+        statement.on_conflict_do_update(index_elements=index_elements,
+                                        set_=set_(statement.excluded)), rows)
+
+
+def insert_or_ignore(table, values: dict, index_elements: list, index_where,
+                     db: Session):
+    # INSERT ... ON CONFLICT DO NOTHING against a (partial) unique index on
+    # SQLite and Postgres; a savepoint absorbs the conflict elsewhere.
+    dialects = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+    dialect_insert = dialects.get(db.get_bind().dialect.name)
+    if dialect_insert is None:
+        try:
+            with db.begin_nested():
+                db.execute(insert(table).values(**values))
+        except IntegrityError:
+            pass
+        return
+    db.execute(
+        dialect_insert(table).values(**values).on_conflict_do_nothing(
+            index_elements=index_elements, index_where=index_where))
 
 
 class ShoppingCart(Base):
@@ -11,6 +65,23 @@ class ShoppingCart(Base):
     orders = relationship("Order", backref="shopping_cart")
     user_id = Column(Integer, ForeignKey("users.id"))
     completed = Column(Boolean, default=False)
+    # Summary kept up to date by every cart change, so it can be read without
+    # touching the orders. recompute_summaries repairs it from the orders.
+    item_count = Column(Integer, nullable=False, default=0)
+    subtotal = Column(Float, nullable=False, default=0.0)
+    # Idempotency key of the checkout that completed the cart.
+    checkout_key = Column(String(64))
+
+    __table_args__ = (
+        UniqueConstraint(user_id, checkout_key),
+        Index("ix_shopping_cart_user_id_completed", user_id, completed),
+        # At most one open cart per user.
+        Index("uq_shopping_cart_open_user_id",
+              user_id,
+              unique=True,
+              sqlite_where=completed == False,
+              postgresql_where=completed == False),
+    )
 
     @staticmethod
     def get_shopping_cart(user_id: int, db: Session):
@@ -20,19 +91,144 @@ class ShoppingCart(Base):
 
     @staticmethod
     def get_current_shopping_cart(user_id: int, db: Session):
-        shopping_cart = db.query(ShoppingCart).filter(
-            ShoppingCart.user_id == user_id,
-            ShoppingCart.completed == False).first()
-        if not shopping_cart:
+        # The open cart and its lines, with the snapshotted name and price of
+        # each line and whether its product is still active, in one query.
+        carts = ShoppingCart.__table__
+        orders = Order.__table__
+        products = Product.__table__
+        rows = db.execute(
+            select(carts.c.id.label("cart_id"), orders.c.id, orders.c.paid,
+                   orders.c.shopping_cart_id, orders.c.product_id,
+                   orders.c.user_id, orders.c.quantity, orders.c.name,
+                   orders.c.price, products.c.is_active).select_from(
+                       carts.outerjoin(orders).outerjoin(products)).where(
+                           carts.c.user_id == user_id,
+                           carts.c.completed == False).order_by(
+                               orders.c.id)).all()
+        if not rows:
             raise HTTPException(status_code=404, detail="Shopping cart not found")
-        return shopping_cart.orders
+        orders = []
+        for row in rows:
+            if row.id is not None:
+                order = row._asdict()
+                del order["cart_id"]
+                orders.append(order)
+        return orders
 
     @staticmethod
-    def get_list_shopping_cart_paid(user_id: int, db: Session):
-        shopping_cart = db.query(ShoppingCart).filter(
-            ShoppingCart.user_id == user_id,
-            ShoppingCart.completed == True).all()
-        return shopping_cart
+    def get_list_shopping_cart_paid(user_id: int, db: Session,
+                                    limit: int = PAGE_SIZE,
+                                    before: int | None = None):
+        # Newest first, keyset paginated on the cart id. The orders of the
+        # whole page, with their product name and price, are loaded by a
+        # second query, so a page always costs two queries.
+        carts = ShoppingCart.__table__
+        orders = Order.__table__
+        products = Product.__table__
+        query = select(carts.c.id, carts.c.user_id, carts.c.completed,
+                       carts.c.item_count, carts.c.subtotal).where(
+                           carts.c.user_id == user_id,
+                           carts.c.completed == True)
+        if before is not None:
+            query = query.where(carts.c.id < before)
+        rows = db.execute(query.order_by(carts.c.id.desc()).limit(limit +
+                                                                  1)).all()
+        shopping_carts = [
+            dict(row._asdict(), orders=[]) for row in rows[:limit]
+        ]
+        next_cursor = shopping_carts[-1]["id"] if len(rows) > limit else None
+        by_id = {cart["id"]: cart for cart in shopping_carts}
+        if by_id:
+            lines = db.execute(
+                select(orders.c.id, orders.c.shopping_cart_id,
+                       orders.c.product_id, orders.c.quantity, orders.c.paid,
+                       func.coalesce(orders.c.name,
+                                     products.c.name).label("name"),
+                       func.coalesce(orders.c.price,
+                                     products.c.price).label("price")
+                       ).select_from(
+                           orders.join(products)).where(
+                               orders.c.shopping_cart_id.in_(by_id)).order_by(
+                                   orders.c.id))
+            for line in lines:
+                by_id[line.shopping_cart_id]["orders"].append(line._asdict())
+        return shopping_carts, next_cursor
+
+    @staticmethod
+    def get_shopping_cart_summary(user_id: int, db: Session):
+        summary = db.query(ShoppingCart.id, ShoppingCart.item_count,
+                           ShoppingCart.subtotal).filter(
+                               ShoppingCart.user_id == user_id,
+                               ShoppingCart.completed == False).first()
+        if not summary:
+            return {"id": None, "item_count": 0, "subtotal": 0.0}
+        return summary._asdict()
+
+    @staticmethod
+    def lock_shopping_cart(shopping_cart_id: int, db: Session):
+        # Takes the write lock on the cart row until the transaction ends: a
+        # row lock on Postgres, the database write lock on SQLite. Callers
+        # that read the lines and write quantities derived from them take it
+        # first, so a concurrent add is not lost in between. Does not commit.
+        carts = ShoppingCart.__table__
+        db.execute(
+            update(carts).where(carts.c.id == shopping_cart_id).values(
+                item_count=carts.c.item_count))
+
+    @staticmethod
+    def update_summary(shopping_cart_id: int, item_count: int,
+                       subtotal: float, db: Session):
+        # Applies a change of the cart content to its summary in SQL, so
+        # concurrent relative changes do not overwrite each other. Changes
+        # computed from lines read earlier must hold lock_shopping_cart.
+        # Does not commit.
+        db.query(ShoppingCart).filter(
+            ShoppingCart.id == shopping_cart_id).update(
+                {
+                    ShoppingCart.item_count:
+                    ShoppingCart.item_count + item_count,
+                    ShoppingCart.subtotal: ShoppingCart.subtotal + subtotal
+                },
+                synchronize_session=False)
+
+    @staticmethod
+    def recompute_summaries(db: Session):
+        # Rebuilds the summary of every open cart from its orders, in one
+        # statement. Returns the number of carts updated.
+        orders = Order.__table__
+        products = Product.__table__
+        carts = ShoppingCart.__table__
+        in_cart = orders.c.shopping_cart_id == carts.c.id
+        item_count = select(func.coalesce(func.sum(orders.c.quantity),
+                                          0)).where(in_cart).scalar_subquery()
+        price = func.coalesce(orders.c.price, products.c.price)
+        subtotal = select(func.coalesce(func.sum(orders.c.quantity * price),
+                                        0.0)).select_from(
+                              orders.join(products)).where(
+                                  in_cart).scalar_subquery()
+        updated = db.execute(
+            update(carts).where(carts.c.completed == False).values(
+                item_count=item_count, subtotal=subtotal)).rowcount
+        db.commit()
+        return updated
+
+    @staticmethod
+    def get_or_create_open_shopping_cart(user_id: int, db: Session):
+        # Returns the id of the user's open cart, creating it if needed. The
+        # common case is one indexed select; on a miss the insert does nothing
+        # if a concurrent request created the cart first, and the select is
+        # repeated. Does not commit.
+        carts = ShoppingCart.__table__
+        query = select(carts.c.id).where(carts.c.user_id == user_id,
+                                         carts.c.completed == False)
+        shopping_cart_id = db.execute(query).scalar()
+        if shopping_cart_id is None:
+            insert_or_ignore(carts, {
+                "user_id": user_id,
+                "completed": False
+            }, ["user_id"], carts.c.completed == False, db)
+            shopping_cart_id = db.execute(query).scalar()
+        return shopping_cart_id
 
     @staticmethod
     def create_shopping_cart(user_id: int, db: Session):
@@ -45,22 +241,156 @@ class ShoppingCart(Base):
     @staticmethod
     def add_product_to_shopping_cart(user_id: int, product_id: int,
                                      db: Session):
-        shopping_cart = db.query(ShoppingCart).filter(
-            ShoppingCart.user_id == user_id,
-            ShoppingCart.completed == False).first()
-        if not shopping_cart:
-            shopping_cart = ShoppingCart.create_shopping_cart(user_id, db)
+        # The cart, if new, the order line and the summary are written in one
+        # transaction.
         product = db.query(Product).filter(Product.id == product_id).first()
         if not product:
             raise HTTPException(status_code=400, detail="Product not found")
         if not product.is_active:
             raise HTTPException(status_code=400,
                                 detail="Product is not active")
-        order = Order.create_order(product_id, shopping_cart.id, db)
-        shopping_cart.orders.append(order)
+        shopping_cart_id = ShoppingCart.get_or_create_open_shopping_cart(
+            user_id, db)
+        Order.create_order(product, user_id, shopping_cart_id, 1, db)
+        # The line keeps the price it was first added at.
+        orders = Order.__table__
+        price = select(orders.c.price).where(
+            orders.c.shopping_cart_id == shopping_cart_id,
+            orders.c.product_id == product_id).scalar_subquery()
+        ShoppingCart.update_summary(shopping_cart_id, 1, price, db)
         db.commit()
-        db.refresh(shopping_cart)
-        return shopping_cart
+        return shopping_cart_id
+
+    @staticmethod
+    def apply_operations_to_shopping_cart(user_id: int, operations: list[dict],
+                                          db: Session):
+        # operations are dicts with "op" (add, remove or set), "id" and
+        # "quantity". They are validated together and applied in order within
+        # one transaction: any failure leaves the cart untouched.
+        product_ids = {operation["id"] for operation in operations}
+        products = {
+            product.id: product
+            for product in db.query(Product.id, Product.is_active,
+                                    Product.name, Product.price).filter(
+                                        Product.id.in_(product_ids))
+        }
+        for operation in operations:
+            if operation["id"] not in products:
+                raise HTTPException(status_code=400,
+                                    detail="Product not found")
+            if (operation["op"] != "remove" and operation["quantity"] > 0
+                    and not products[operation["id"]].is_active):
+                raise HTTPException(status_code=400,
+                                    detail="Product is not active")
+        shopping_cart_id = ShoppingCart.get_or_create_open_shopping_cart(
+            user_id, db)
+        # The new quantities and the summary delta are computed from the
+        # lines read below, so no other change may commit in between.
+        ShoppingCart.lock_shopping_cart(shopping_cart_id, db)
+        # Existing lines keep the price they were added at.
+        prices = {id: product.price for id, product in products.items()}
+        lines = {}
+        for line in db.query(Order.product_id, Order.quantity,
+                             Order.price).filter(
+                                 Order.shopping_cart_id == shopping_cart_id,
+                                 Order.product_id.in_(product_ids)):
+            lines[line.product_id] = line.quantity
+            if line.price is not None:
+                prices[line.product_id] = line.price
+        quantities = dict(lines)
+        for operation in operations:
+            product_id = operation["id"]
+            if operation["op"] == "add":
+                quantities[product_id] = (quantities.get(product_id, 0) +
+                                          operation["quantity"])
+            elif operation["op"] == "set":
+                quantities[product_id] = operation["quantity"]
+            elif quantities.get(product_id, 0) > 0:
+                quantities[product_id] = 0
+            else:
+                raise HTTPException(status_code=400,
+                                    detail="Order not found")
+        changed = {
+            product_id: quantity
+            for product_id, quantity in quantities.items()
+            if quantity != lines.get(product_id, 0)
+        }
+        Order.set_quantities(user_id, shopping_cart_id, changed, products, db)
+        ShoppingCart.update_summary(
+            shopping_cart_id,
+            sum(quantity - lines.get(product_id, 0)
+                for product_id, quantity in changed.items()),
+            sum((quantity - lines.get(product_id, 0)) * prices[product_id]
+                for product_id, quantity in changed.items()), db)
+        db.commit()
+        return shopping_cart_id
+
+    @staticmethod
+    def checkout_shopping_cart(user_id: int, checkout_key: str | None,
+                               db: Session):
+        # Completes the open cart in one transaction of set-based statements:
+        # one UPDATE marks every line paid, filling in the unit price of lines
+        # added before prices were snapshotted, and one UPDATE closes the cart
+        # with its final totals. A checkout_key already used by this user
+        # returns that checkout instead.
+        carts = ShoppingCart.__table__
+        orders = Order.__table__
+        products = Product.__table__
+        summary = select(carts.c.id, carts.c.item_count, carts.c.subtotal)
+        done = summary.where(carts.c.user_id == user_id,
+                             carts.c.checkout_key == checkout_key)
+        if checkout_key is not None:
+            checkout = db.execute(done).first()
+            if checkout:
+                return checkout._asdict()
+        shopping_cart_id = db.execute(
+            select(carts.c.id).where(carts.c.user_id == user_id,
+                                     carts.c.completed == False)).scalar()
+        if shopping_cart_id is None:
+            raise HTTPException(status_code=404,
+                                detail="Shopping cart not found")
+        price = select(products.c.price).where(
+            products.c.id == orders.c.product_id).scalar_subquery()
+        paid = db.execute(
+            update(orders).where(
+                orders.c.shopping_cart_id == shopping_cart_id).values(
+                    paid=True,
+                    price=func.coalesce(orders.c.price, price))).rowcount
+        if not paid:
+            db.rollback()
+            raise HTTPException(status_code=400,
+                                detail="Shopping cart is empty")
+        in_cart = orders.c.shopping_cart_id == carts.c.id
+        item_count = select(func.sum(
+            orders.c.quantity)).where(in_cart).scalar_subquery()
+        subtotal = select(func.sum(orders.c.quantity *
+                                   orders.c.price)).where(
+                                       in_cart).scalar_subquery()
+        completed = db.execute(
+            update(carts).where(carts.c.id == shopping_cart_id,
+                                carts.c.completed == False).values(
+                                    completed=True,
+                                    checkout_key=checkout_key,
+                                    item_count=item_count,
+                                    subtotal=subtotal)).rowcount
+        if not completed:
+            # A concurrent checkout completed the cart first.
+            db.rollback()
+        else:
+            try:
+                db.commit()
+            except IntegrityError:
+                # The same key completed another cart concurrently.
+                db.rollback()
+            else:
+                replica_router.mark_write("orders")
+                return db.execute(summary.where(
+                    carts.c.id == shopping_cart_id)).first()._asdict()
+        checkout = db.execute(done).first() if checkout_key else None
+        if not checkout:
+            raise HTTPException(status_code=409,
+                                detail="Shopping cart already checked out")
+        return checkout._asdict()
 
     @staticmethod
     def remove_product_from_shopping_cart(user_id: int, product_id: int,
@@ -73,36 +403,86 @@ class ShoppingCart(Base):
         product = db.query(Product).filter(Product.id == product_id).first()
         if not product:
             raise HTTPException(status_code=400, detail="Product not found")
+        # The summary delta is computed from the lines read below.
+        ShoppingCart.lock_shopping_cart(shopping_cart.id, db)
         order = Order.get_orders(product_id, shopping_cart.id, db)
         if not order:
             raise HTTPException(status_code=400, detail="Order not found")
+        quantity = sum(item.quantity for item in order)
+        amount = sum(item.quantity * (product.price if item.price is None
+                                      else item.price) for item in order)
         for item in order:
             db.delete(item)
+        ShoppingCart.update_summary(shopping_cart.id, -quantity, -amount, db)
         db.commit()
-        db.refresh(shopping_cart)
         return shopping_cart
     
 class Order(Base):
     __tablename__ = "order"
+    # One line per product in a cart; adding a product again raises quantity.
+    __table_args__ = (UniqueConstraint("shopping_cart_id", "product_id"), )
 
     id = Column(Integer, primary_key=True, index=True)
     product_id = Column(Integer, ForeignKey("product.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
     paid = Column(Boolean, default=False)
     shopping_cart_id = Column(Integer, ForeignKey("shopping_cart.id"))
+    quantity = Column(Integer, nullable=False, default=1)
+    # Product name and unit price when the line was added.
+    name = Column(String(50))
+    price = Column(Float)
     
     @staticmethod
-    def create_order(product_id: int, user_id: int, db: Session):
-        order = Order(product_id=product_id, user_id=user_id)
-        db.add(order)
-        db.commit()
-        db.refresh(order)
-        return order
+    def create_order(product: "Product", user_id: int, shopping_cart_id: int,
+                     quantity: int, db: Session):
+        # Upserts the cart line without committing, so callers control the
+        # transaction. A new line snapshots the product name and price.
+        upsert(Order.__table__, [{
+            "product_id": product.id,
+            "user_id": user_id,
+            "shopping_cart_id": shopping_cart_id,
+            "quantity": quantity,
+            "paid": False,
+            "name": product.name,
+            "price": product.price
+        }], ["shopping_cart_id", "product_id"],
+               lambda excluded: {
+                   "quantity": Order.__table__.c.quantity + excluded.quantity
+               }, db)
+
+    @staticmethod
+    def set_quantities(user_id: int, shopping_cart_id: int,
+                       quantities: dict, products: dict, db: Session):
+        # Sets the quantity of several lines at once; lines set to zero are
+        # deleted. New lines snapshot the name and price from products, keyed
+        # by id. Does not commit.
+        rows = [{
+            "product_id": product_id,
+            "user_id": user_id,
+            "shopping_cart_id": shopping_cart_id,
+            "quantity": quantity,
+            "paid": False,
+            "name": products[product_id].name,
+            "price": products[product_id].price
+        } for product_id, quantity in quantities.items() if quantity > 0]
+        if rows:
+            upsert(Order.__table__, rows, ["shopping_cart_id", "product_id"],
+                   lambda excluded: {"quantity": excluded.quantity}, db)
+        removed = [
+            product_id for product_id, quantity in quantities.items()
+            if quantity <= 0
+        ]
+        if removed:
+            db.query(Order).filter(
+                Order.shopping_cart_id == shopping_cart_id,
+                Order.product_id.in_(removed)).delete(
+                    synchronize_session=False)
     
     @staticmethod
-    def get_orders(product_id: int, user_id: int, db: Session):
-        order = db.query(Order).filter(Order.product_id == product_id,
-                                       Order.user_id == user_id).all()
+    def get_orders(product_id: int, shopping_cart_id: int, db: Session):
+        order = db.query(Order).filter(
+            Order.product_id == product_id,
+            Order.shopping_cart_id == shopping_cart_id).all()
         return order
 
 class Product(Base):
@@ -110,16 +490,71 @@ class Product(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(50), unique=True, index=True)
+    # Lower-cased copy of name so case-insensitive lookups use an index.
+    name_key = Column(String(50), unique=True, index=True)
     price = Column(Float)
     is_active = Column(Boolean, default=True)
 
+    @validates("name")
+    def validate_name(self, key, name):
+        self.name_key = name.lower()
+        return name
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "price": self.price,
+            "is_active": self.is_active
+        }
+
     @staticmethod
     def get_product(name: str, db: Session):
-        product = db.query(Product).filter(Product.name.ilike(name)).first()
+        product = db.query(Product).filter(
+            Product.name_key == name.lower()).first()
         if not product:
             raise HTTPException(status_code=400, detail="Product not found")
         return product
 
+    @staticmethod
+    def get_product_info(name: str, db: Session):
+        product = catalog_cache.get(name_key(name))
+        if product is None:
+            product = Product.get_product(name, db).to_dict()
+            cache_product(product)
+        return product
+
+    @staticmethod
+    def get_products_info(ids: list[int], names: list[str], db: Session):
+        # Resolves ids and names from the catalog cache, then fetches all the
+        # misses with one IN query. Results keep the request order and unknown
+        # products are None.
+        by_id = {id: catalog_cache.get(id_key(id)) for id in ids}
+        by_name = {
+            name.lower(): catalog_cache.get(name_key(name))
+            for name in names
+        }
+        missing_ids = [id for id, product in by_id.items() if product is None]
+        missing_keys = [
+            key for key, product in by_name.items() if product is None
+        ]
+        if missing_ids or missing_keys:
+            rows = db.query(Product.id, Product.name, Product.price,
+                            Product.is_active).filter(
+                                or_(Product.id.in_(missing_ids),
+                                    Product.name_key.in_(missing_keys))).all()
+            for row in rows:
+                product = row._asdict()
+                cache_product(product)
+                if row.id in by_id:
+                    by_id[row.id] = product
+                if row.name.lower() in by_name:
+                    by_name[row.name.lower()] = product
+        return {
+            "ids": [by_id[id] for id in ids],
+            "names": [by_name[name.lower()] for name in names]
+        }
+
     @staticmethod
     def get_all_products(db: Session):
         return db.query(Product).all()
@@ -128,26 +563,180 @@ class Product(Base):
     def get_active_products(db: Session):
         return db.query(Product).filter(Product.is_active == True).all()
 
+    @staticmethod
+    def get_products_page(db: Session, limit: int = PAGE_SIZE,
+                          after: int | None = None, active_only: bool = False):
+        # Keyset pagination on the primary key: each page is an index range
+        # scan starting right after the last id of the previous page.
+        # Core select of the listed columns: rows come back as plain tuples,
+        # without building ORM instances.
+        table = Product.__table__
+        query = select(table.c.id, table.c.name, table.c.price,
+                       table.c.is_active)
+        if active_only:
+            query = query.where(table.c.is_active == True)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        rows = db.execute(query.order_by(table.c.id).limit(limit + 1)).all()
+        products = [row._asdict() for row in rows[:limit]]
+        next_cursor = products[-1]["id"] if len(rows) > limit else None
+        return products, next_cursor
+
+    @staticmethod
+    def get_cached_products_page(db: Session, limit: int = PAGE_SIZE,
+                                 after: int | None = None,
+                                 active_only: bool = False):
+        # Only first pages are cached; later pages come from a keyset query
+        # on the primary key, which is cheap and rarely repeated.
+        if after is not None:
+            return Product.get_products_page(db, limit, after, active_only)
+        return page_cache.get_or_set(
+            page_key(limit, active_only),
+            lambda: Product.get_products_page(db, limit, None, active_only))
+
+    @staticmethod
+    def iter_products(db: Session, chunk_size: int = PAGE_SIZE,
+                      active_only: bool = False):
+        after = None
+        while True:
+            products, after = Product.get_products_page(
+                db, chunk_size, after, active_only)
+            if products:
+                yield products
+            if after is None:
+                break
+
     @staticmethod
     def create_product(name: str, price: int, db: Session):
+        # The unique name_key rejects a name that differs from an existing
+        # one only in case, as well as concurrent creates of the same name.
         product = Product(name=name, price=price)
         db.add(product)
-        db.commit()
+        try:
+            CatalogVersion.bump(db)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=400,
+                                detail="Product already exists")
         db.refresh(product)
+        invalidate_product(product.id, product.name)
         return product
     
+    @staticmethod
+    def bulk_upsert_products(rows: list[dict], db: Session):
+        # rows are dicts with "row", "name" and "price". New names are inserted
+        # and existing ones repriced with one executemany statement each, all
+        # in a single transaction. A name repeated in rows keeps the last price.
+        try:
+            results = Product._bulk_upsert_products(rows, db)
+        except IntegrityError:
+            # A concurrent writer created some of the names; they are now
+            # visible, so the retry turns those inserts into updates.
+            db.rollback()
+            results = Product._bulk_upsert_products(rows, db)
+        catalog_cache.clear()
+        page_cache.clear()
+        return results
+
+    @staticmethod
+    def _bulk_upsert_products(rows: list[dict], db: Session):
+        table = Product.__table__
+        keys = {row["name"].lower() for row in rows}
+        existing = dict(
+            db.query(Product.name_key,
+                     Product.id).filter(Product.name_key.in_(keys)).all())
+        inserts, updates, results = {}, {}, []
+        for row in rows:
+            key = row["name"].lower()
+            if key in existing:
+                updates[existing[key]] = {
+                    "_id": existing[key],
+                    "_price": row["price"]
+                }
+                status = "updated"
+            elif key in inserts:
+                inserts[key]["price"] = row["price"]
+                status = "updated"
+            else:
+                inserts[key] = {
+                    "name": row["name"],
+                    "name_key": key,
+                    "price": row["price"],
+                    "is_active": True
+                }
+                status = "created"
+            results.append({
+                "row": row["row"],
+                "name": row["name"],
+                "status": status
+            })
+        if inserts:
+            db.execute(insert(table), list(inserts.values()))
+            existing.update(
+                db.query(Product.name_key, Product.id).filter(
+                    Product.name_key.in_(inserts)).all())
+        if updates:
+            db.execute(
+                update(table).where(table.c.id == bindparam("_id")).values(
+                    price=bindparam("_price")), list(updates.values()))
+        CatalogVersion.bump(db)
+        db.commit()
+        for result in results:
+            result["id"] = existing[result["name"].lower()]
+        return results
+
     @staticmethod
     def update_product(name: str, price: int, db: Session):
         product = Product.get_product(name, db)
         product.price = price
+        CatalogVersion.bump(db)
         db.commit()
         db.refresh(product)
+        invalidate_product(product.id, product.name)
         return product
     
     @staticmethod
     def delete_product(name: str, db: Session):
         product = Product.get_product(name, db)
         product.is_active = False
+        CatalogVersion.bump(db)
         db.commit()
         db.refresh(product)
+        invalidate_product(product.id, product.name)
         return product
+
+
+class CatalogVersion(Base):
+    # Single row counting catalog writes. Product writes bump it in their own
+    # transaction; readers use it to validate cached client representations.
+    __tablename__ = "catalog_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def bump(db: Session):
+        updated = db.query(CatalogVersion).filter(
+            CatalogVersion.id == 1).update(
+                {
+                    CatalogVersion.version: CatalogVersion.version + 1,
+                    CatalogVersion.updated_at: datetime.utcnow()
+                },
+                synchronize_session=False)
+        if not updated:
+            db.add(CatalogVersion(id=1, version=1))
+        replica_router.mark_write("catalog")
+
+    @staticmethod
+    def get_version(db: Session):
+        # Served from the catalog cache, so unchanged catalogs are validated
+        # without a query until the entry expires or a local write drops it.
+        def load():
+            row = db.query(CatalogVersion.version,
+                           CatalogVersion.updated_at).filter(
+                               CatalogVersion.id == 1).first()
+            return (row.version, row.updated_at) if row else (0, None)
+
+        return catalog_cache.get_or_set(version_key(), load)
@@ -0,0 +1,27 @@
+# responses.py
+# This file contains the response class used by read-only catalog listings.
+# Rows are encoded straight to bytes with orjson when it is installed, and
+# with the standard json module otherwise, skipping jsonable_encoder.
+
+import json
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
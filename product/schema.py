@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from config.settings import MAX_PAGE_SIZE
+from typing import Literal
+
+from pydantic import BaseModel, Field
 
 
 class ProductCreate(BaseModel):
@@ -27,3 +30,37 @@ class ProductName(BaseModel):
         
 class ProductID(BaseModel):
     id: int
+
+
+class ProductLookup(BaseModel):
+    ids: list[int] = Field(default_factory=list, max_items=MAX_PAGE_SIZE)
+    names: list[str] = Field(default_factory=list, max_items=MAX_PAGE_SIZE)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "ids": [1, 2],
+                "names": ["Product 1"],
+            }
+        }
+
+
+class CartOperation(BaseModel):
+    op: Literal["add", "remove", "set"]
+    id: int
+    quantity: int = Field(1, ge=0)
+
+
+class CartOperations(BaseModel):
+    operations: list[CartOperation] = Field(..., max_items=MAX_PAGE_SIZE)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "operations": [
+                    {"op": "add", "id": 1, "quantity": 2},
+                    {"op": "set", "id": 2, "quantity": 1},
+                    {"op": "remove", "id": 3},
+                ]
+            }
+        }
@@ -1,4 +1,17 @@
+import json
+import threading
+import time
+
+import pytest
+from config.replica import ReplicaRouter
+from config.settings import get_db
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from user.models import User
+
+from product.models import Order, Product, ShoppingCart, insert_or_ignore
 
 
 def test_create_product(client: TestClient):
@@ -29,6 +42,17 @@ def test_create_product(client: TestClient):
     assert response.json() == {
         "message": "Product product 1 created successfully"
     }
+    for name in ("product 1", "Product 1"):
+        response = client.post(
+            "/product/create",
+            headers={"Authorization": f"Bearer {token}"},
+            json={
+                "name": name,
+                "price": 100.0
+            },
+        )
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Product already exists"}
 
 
 def test_get_product(client: TestClient):
@@ -42,6 +66,23 @@ def test_get_product(client: TestClient):
     }
 
 
+def test_catalog_cache_stats(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/product/cache-stats").status_code == 401
+    before = client.get("/product/cache-stats", headers=headers).json()
+    client.post("/product/info", json={"name": "PRODUCT 1"})
+    after = client.get("/product/cache-stats", headers=headers).json()
+    assert after["hits"] > before["hits"]
+    assert after["misses"] == before["misses"]
+
+
 def test_list_products(client: TestClient):
     response = client.get("/product/list")
     print(response.json())
@@ -65,6 +106,61 @@ def test_list_active_products(client: TestClient):
     }
 
 
+def test_list_products_pagination(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    for name in ("product 2", "product 3"):
+        client.post(
+            "/product/create",
+            headers={"Authorization": f"Bearer {token}"},
+            json={
+                "name": name,
+                "price": 50.0
+            },
+        )
+    response = client.get("/product/list", params={"limit": 2})
+    assert response.status_code == 200
+    assert [product["id"] for product in response.json()] == [1, 2]
+    assert response.headers["X-Next-Cursor"] == "2"
+    response = client.get("/product/list", params={"limit": 2, "after": 2})
+    assert response.status_code == 200
+    assert [product["id"] for product in response.json()] == [3]
+    assert "X-Next-Cursor" not in response.headers
+    # Pages after the first are not cached
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    before = client.get("/product/cache-stats", headers=headers).json()
+    client.get("/product/list", params={"limit": 1, "after": 1})
+    after = client.get("/product/cache-stats", headers=headers).json()
+    assert after["size"] == before["size"]
+    assert after["pages"]["size"] == before["pages"]["size"]
+
+
+def test_list_products_stream(client: TestClient):
+    response = client.get("/product/list_active", params={"stream": True})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0]) == {
+        "id": 1,
+        "name": "product 1",
+        "price": 100.0,
+        "is_active": True
+    }
+
+
 def test_add_product_to_shopping_cart(client: TestClient):
     token = client.post(
         "/user/token",
@@ -103,9 +199,35 @@ def test_get_current_shopping_cart(client: TestClient):
         'id': 1,
         'shopping_cart_id': 1,
         'product_id': 1,
-        'user_id': 1
+        'user_id': 1,
+        'quantity': 1,
+        'name': 'product 1',
+        'price': 100.0,
+        'is_active': True
     }
 
+
+def test_add_product_to_shopping_cart_again(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    response = client.post(
+        "/product/add-to-cart",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"id": 1},
+    )
+    assert response.status_code == 200
+    response = client.get(
+        "/product/shopping-cart",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert len(response.json()) == 1
+    assert response.json()[0]["quantity"] == 2
+
 def test_remove_product_from_shopping_cart(client: TestClient):
     token = client.post(
         "/user/token",
@@ -144,6 +266,8 @@ def test_update_product(client: TestClient):
     assert response.json() == {
         "message": "Product product 1 updated successfully; new price: 200.0"
     }
+    response = client.post("/product/info", json={"name": "product 1"})
+    assert response.json()["price"] == 200.0
 
 def test_delete_product(client: TestClient):
     token = client.post(
@@ -161,4 +285,489 @@ def test_delete_product(client: TestClient):
     assert response.status_code == 200
     assert response.json() == {
         "message": "Product product 1 deleted successfully"
-    }
\ No newline at end of file
+    }
+
+def test_bulk_upsert_products(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    response = client.post(
+        "/product/bulk",
+        headers={"Authorization": f"Bearer {token}"},
+        json=[
+            {"name": "product 4", "price": 10.0},
+            {"name": "PRODUCT 2", "price": 60.0},
+            {"name": "product 5"},
+        ],
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [
+        "created", "updated", "error"
+    ]
+    assert results[1]["id"] == 2
+    response = client.post("/product/info", json={"name": "product 2"})
+    assert response.json()["price"] == 60.0
+
+    response = client.post(
+        "/product/bulk",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/x-ndjson"
+        },
+        data='{"name": "product 5", "price": 5.0}\n'
+        '{"name": "product 4", "price": 4.0}\n',
+    )
+    assert [(result["status"], result["name"])
+            for result in response.json()["results"]] == [
+                ("created", "product 5"), ("updated", "product 4")
+            ]
+
+    response = client.post(
+        "/product/bulk",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "text/csv"
+        },
+        data="name,price\nproduct 6,6.0\nproduct 5,5.5\n",
+    )
+    assert [result["status"] for result in response.json()["results"]] == [
+        "created", "updated"
+    ]
+
+    response = client.post(
+        "/product/bulk",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        },
+        data='[{"name": "product 7", ',
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid JSON body"}
+
+    response = client.post(
+        "/product/bulk",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "text/csv"
+        },
+        data=b"name,price\nproduct \xff,7.0\nproduct 6,6.5\n",
+    )
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == [
+        "error", "updated"
+    ]
+
+
+def test_get_products_info(client: TestClient):
+    response = client.post(
+        "/product/info/batch",
+        json={
+            "ids": [3, 999, 2],
+            "names": ["PRODUCT 4", "missing"]
+        },
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert [product and product["id"] for product in body["ids"]] == [
+        3, None, 2
+    ]
+    assert body["names"][0]["name"] == "product 4"
+    assert body["names"][1] is None
+
+
+def test_catalog_conditional_get(client: TestClient):
+    response = client.get("/product/list_active")
+    etag = response.headers["ETag"]
+    response = client.get("/product/list_active",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.post("/product/info",
+                           json={"name": "product 2"},
+                           headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    time.sleep(1)
+    last_modified = client.get("/product/list").headers["Last-Modified"]
+    response = client.get("/product/list",
+                          headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = client.get(
+        "/product/list",
+        headers={"If-Modified-Since": "Sun, 18 Oct 2099 10:00:00 -0000"})
+    assert response.status_code == 304
+
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    client.put(
+        "/product/update",
+        headers={"Authorization": f"Bearer {token}"},
+        json={
+            "name": "product 2",
+            "price": 70.0
+        },
+    )
+    response = client.get("/product/list_active",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    response = client.get("/product/list",
+                          headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 200
+    assert "Last-Modified" not in response.headers
+
+
+def test_update_shopping_cart(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def cart_lines():
+        response = client.get("/product/shopping-cart", headers=headers)
+        return {
+            order["product_id"]: order["quantity"]
+            for order in response.json()
+        }
+
+    response = client.post(
+        "/product/update-cart",
+        headers=headers,
+        json={
+            "operations": [
+                {"op": "add", "id": 2, "quantity": 2},
+                {"op": "set", "id": 3, "quantity": 1},
+                {"op": "add", "id": 3},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Shopping cart updated successfully"
+    }
+    assert cart_lines() == {2: 2, 3: 2}
+
+    response = client.post(
+        "/product/update-cart",
+        headers=headers,
+        json={
+            "operations": [
+                {"op": "add", "id": 4},
+                {"op": "add", "id": 999},
+            ]
+        },
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Product not found"}
+    response = client.post(
+        "/product/update-cart",
+        headers=headers,
+        json={"operations": [{"op": "add", "id": 1}]},
+    )
+    assert response.json() == {"detail": "Product is not active"}
+    assert cart_lines() == {2: 2, 3: 2}
+
+    response = client.post(
+        "/product/update-cart",
+        headers=headers,
+        json={
+            "operations": [
+                {"op": "remove", "id": 3},
+                {"op": "set", "id": 2, "quantity": 0},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert cart_lines() == {}
+
+
+def test_get_shopping_cart_summary(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post(
+        "/product/update-cart",
+        headers=headers,
+        json={"operations": [{"op": "add", "id": 2, "quantity": 2}]},
+    )
+    client.post("/product/add-to-cart", headers=headers, json={"id": 3})
+    response = client.get("/product/shopping-cart/summary", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"id": 1, "item_count": 3, "subtotal": 190.0}
+    client.post("/product/remove-from-cart", headers=headers, json={"id": 2})
+    response = client.get("/product/shopping-cart/summary", headers=headers)
+    assert response.json() == {"id": 1, "item_count": 1, "subtotal": 50.0}
+
+
+def test_list_shopping_cart_paid(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    response = client.get(
+        "/product/shopping-cart-paid",
+        headers={"Authorization": f"Bearer {token}"},
+        params={"limit": 10},
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_checkout_shopping_cart(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Idempotency-Key": "checkout-1"
+    }
+    response = client.post("/product/checkout", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Shopping cart checked out successfully",
+        "id": 1,
+        "item_count": 1,
+        "subtotal": 50.0
+    }
+    response = client.post("/product/checkout", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["id"] == 1
+
+    response = client.post(
+        "/product/checkout",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 404
+    response = client.get(
+        "/product/shopping-cart-paid",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    orders = response.json()[0]["orders"]
+    for order in orders:
+        order.pop("id")
+    assert orders == [{
+        "shopping_cart_id": 1,
+        "product_id": 3,
+        "quantity": 1,
+        "paid": True,
+        "name": "product 3",
+        "price": 50.0
+    }]
+
+
+def test_list_shopping_cart_paid_pages(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for _ in range(2):
+        client.post("/product/add-to-cart", headers=headers, json={"id": 3})
+    response = client.post("/product/checkout", headers=headers)
+    assert response.status_code == 200
+    newest = response.json()["id"]
+
+    # Newest first, one cart per page, each with its own orders.
+    response = client.get("/product/shopping-cart-paid",
+                          headers=headers,
+                          params={"limit": 1})
+    assert response.status_code == 200
+    assert response.headers["X-Next-Cursor"] == str(newest)
+    [cart] = response.json()
+    assert cart["id"] == newest
+    assert [(order["shopping_cart_id"], order["product_id"], order["quantity"])
+            for order in cart["orders"]] == [(newest, 3, 2)]
+
+    response = client.get("/product/shopping-cart-paid",
+                          headers=headers,
+                          params={
+                              "limit": 1,
+                              "before": response.headers["X-Next-Cursor"]
+                          })
+    assert response.status_code == 200
+    assert "X-Next-Cursor" not in response.headers
+    [cart] = response.json()
+    assert cart["id"] == 1 < newest
+    assert [(order["shopping_cart_id"], order["product_id"], order["quantity"])
+            for order in cart["orders"]] == [(1, 3, 1)]
+
+
+def test_shopping_cart_price_snapshot(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "test",
+            "password": "test"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/product/add-to-cart", headers=headers, json={"id": 4})
+    client.put(
+        "/product/update",
+        headers=headers,
+        json={
+            "name": "product 4",
+            "price": 40.0
+        },
+    )
+    client.post("/product/add-to-cart", headers=headers, json={"id": 4})
+    response = client.get("/product/shopping-cart", headers=headers)
+    assert response.status_code == 200
+    line = response.json()[0]
+    assert (line["name"], line["price"], line["quantity"]) == ("product 4",
+                                                               4.0, 2)
+    response = client.get("/product/shopping-cart/summary", headers=headers)
+    assert response.json()["subtotal"] == 8.0
+
+
+def test_update_cart_concurrent_add(client: TestClient):
+    # An add committed while the batch waits for the cart must not be lost.
+    sessions = client.app.dependency_overrides[get_db]
+    db, other = next(sessions()), next(sessions())
+    user_id = User.get_user("test", db).id
+    product = db.query(Product).filter(Product.id == 4).first()
+    shopping_cart_id = ShoppingCart.get_or_create_open_shopping_cart(
+        user_id, db)
+    Order.create_order(product, user_id, shopping_cart_id, 1, db)
+    ShoppingCart.update_summary(shopping_cart_id, 1, 4.0, db)
+    errors = []
+
+    def apply():
+        try:
+            ShoppingCart.apply_operations_to_shopping_cart(
+                user_id, [{"op": "add", "id": 4, "quantity": 1}], other)
+        except Exception as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=apply)
+    thread.start()
+    time.sleep(0.5)
+    db.commit()
+    thread.join()
+    assert not errors
+    line = Order.get_orders(4, shopping_cart_id, db)[0]
+    summary = ShoppingCart.get_shopping_cart_summary(user_id, db)
+    assert line.quantity == 4
+    assert (summary["item_count"], summary["subtotal"]) == (4, 16.0)
+    db.close()
+    other.close()
+
+
+def test_remove_from_cart_concurrent_add(client: TestClient):
+    # An add committed while the removal waits for the cart must be removed
+    # from the summary too.
+    sessions = client.app.dependency_overrides[get_db]
+    db, other = next(sessions()), next(sessions())
+    user_id = User.get_user("test", db).id
+    product = db.query(Product).filter(Product.id == 4).first()
+    shopping_cart_id = ShoppingCart.get_or_create_open_shopping_cart(
+        user_id, db)
+    Order.create_order(product, user_id, shopping_cart_id, 1, db)
+    ShoppingCart.update_summary(shopping_cart_id, 1, 4.0, db)
+    errors = []
+
+    def remove():
+        try:
+            ShoppingCart.remove_product_from_shopping_cart(user_id, 4, other)
+        except Exception as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=remove)
+    thread.start()
+    time.sleep(0.5)
+    db.commit()
+    thread.join()
+    assert not errors
+    assert not Order.get_orders(4, shopping_cart_id, db)
+    lines = db.query(Order).filter(
+        Order.shopping_cart_id == shopping_cart_id).all()
+    summary = ShoppingCart.get_shopping_cart_summary(user_id, db)
+    assert summary["item_count"] == sum(line.quantity for line in lines)
+    assert summary["subtotal"] == sum(line.quantity * line.price
+                                      for line in lines)
+    db.close()
+    other.close()
+
+
+def test_open_shopping_cart_unique(client: TestClient):
+    # The partial unique index allows one open cart per user.
+    db = next(client.app.dependency_overrides[get_db]())
+    carts = ShoppingCart.__table__
+    user_id = User.get_user("test", db).id
+    shopping_cart_id = ShoppingCart.get_or_create_open_shopping_cart(
+        user_id, db)
+    assert ShoppingCart.get_or_create_open_shopping_cart(
+        user_id, db) == shopping_cart_id
+    insert_or_ignore(carts, {
+        "user_id": user_id,
+        "completed": False
+    }, ["user_id"], carts.c.completed == False, db)
+    with pytest.raises(IntegrityError):
+        with db.begin_nested():
+            db.execute(insert(carts).values(user_id=user_id, completed=False))
+    open_carts = db.query(ShoppingCart).filter(
+        ShoppingCart.user_id == user_id,
+        ShoppingCart.completed == False).all()
+    assert [cart.id for cart in open_carts] == [shopping_cart_id]
+    db.rollback()
+    db.close()
+
+
+def test_replica_router(tmp_path):
+    def sessions(path):
+        engine = create_engine(f"sqlite:///{path}")
+        return sessionmaker(bind=engine)
+
+    primary = sessions(tmp_path / "primary.db")
+    replica = sessions(tmp_path / "replica.db")
+    router = ReplicaRouter(lambda: primary, lambda: replica, None, None,
+                           max_lag=60, retry_seconds=60)
+    db = router.session("catalog")
+    assert db.get_bind().url.database.endswith("replica.db")
+    db.close()
+    # Reads of a scope stay on the primary after a write of that scope
+    router.mark_write("catalog")
+    db = router.session("catalog")
+    assert db.get_bind().url.database.endswith("primary.db")
+    db.close()
+    db = router.session("orders")
+    assert db.get_bind().url.database.endswith("replica.db")
+    db.close()
+    # An unreachable replica falls back to the primary
+    missing = sessions(tmp_path / "missing" / "x.db")
+    router = ReplicaRouter(lambda: primary, lambda: missing, None, None,
+                           max_lag=60, retry_seconds=60)
+    db = router.session("orders")
+    assert db.get_bind().url.database.endswith("primary.db")
+    assert not router.use_replica("orders")
+    db.close()
@@ -1,16 +1,30 @@
-from config.settings import get_db
-from fastapi import APIRouter, Depends, status
+from config.replica import (get_async_orders_read_db, get_async_read_db,
+                            get_read_db)
+from config.settings import MAX_PAGE_SIZE, PAGE_SIZE, get_async_db, get_db
+from fastapi import (APIRouter, Depends, Header, Query, Request, Response,
+                     status)
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from user.models import User
 from user.views import get_current_active_user
 
-from .schema import ProductCreate, ProductID, ProductName
-from .views import (add_product_to_shopping_cart_view, create_product_view,
+from .responses import FastJSONResponse
+from .schema import (CartOperations, ProductCreate, ProductID, ProductLookup,
+                     ProductName)
+from .views import (add_product_to_shopping_cart_view,
+                    apply_operations_to_shopping_cart_view,
+                    checkout_shopping_cart_view,
+                    bulk_upsert_products_view, catalog_cache_stats_view,
+                    catalog_headers_view, catalog_not_modified_view,
+                    create_product_view,
                     get_current_shopping_cart_view, get_product_view,
+                    get_products_info_view, get_shopping_cart_summary_view,
                     list_active_products_view, list_products_view,
                     list_shopping_cart_paid_view,
                     remove_product_from_shopping_cart_view,
-                    update_product_view, delete_product_view)
+                    stream_products_view, update_product_view,
+                    delete_product_view)
 
 router = APIRouter(
     prefix="/product",
@@ -57,13 +71,75 @@ router = APIRouter(
                      }
                  },
              })
-def create_product(product: ProductCreate,
-                   current_user: User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    product = create_product_view(product.name, product.price, db)
+async def create_product(product: ProductCreate,
+                         current_user: User = Depends(get_current_active_user),
+                         db: AsyncSession = Depends(get_async_db)):
+    product = await create_product_view(product.name, product.price, db)
     return {"message": f"Product {product.name} created successfully"}
 
 
+@router.post(
+    "/bulk",
+    status_code=status.HTTP_200_OK,
+    summary="Create or update products in bulk",
+    description="The body is a JSON array of products, or a streamed "
+    "`application/x-ndjson` or `text/csv` (header `name,price`) body. "
+    "Products are matched by name case-insensitively: new ones are created, "
+    "existing ones get the new price. Rows are written in chunks, one "
+    "transaction per chunk, and a result is returned for every row.",
+    responses={
+        200: {
+            "description": "Per-row results",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "results": [{
+                            "row": 0,
+                            "name": "Product 1",
+                            "status": "created",
+                            "id": 1
+                        }, {
+                            "row": 1,
+                            "status": "error",
+                            "detail": [{
+                                "loc": ["price"],
+                                "msg": "field required",
+                                "type": "value_error.missing"
+                            }]
+                        }]
+                    }
+                }
+            }
+        },
+        400: {
+            "description": "The JSON body is malformed or not a list",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Invalid JSON body"
+                    }
+                }
+            }
+        },
+        401: {
+            "description": "Unauthorized",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Not authenticated"
+                    }
+                }
+            }
+        },
+    })
+async def bulk_upsert_products(
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)):
+    results = await bulk_upsert_products_view(request, db)
+    return {"results": results}
+
+
 @router.post("/info",
              status_code=status.HTTP_200_OK,
              summary="Get product info",
@@ -92,11 +168,46 @@ def create_product(product: ProductCreate,
                      }
                  },
              })
-def get_product(product: ProductName, db: Session = Depends(get_db)):
-    product = get_product_view(product.name, db)
+async def get_product(product: ProductName,
+                      db: AsyncSession = Depends(get_async_read_db)):
+    product = await get_product_view(product.name, db)
     return product
 
 
+@router.post("/info/batch",
+             status_code=status.HTTP_200_OK,
+             summary="Get info of several products",
+             description="Looks products up by id and by name in one query. "
+             "Each list in the response follows the order of the request; "
+             "products that do not exist are `null`.",
+             responses={
+                 200: {
+                     "description": "Products info",
+                     "content": {
+                         "application/json": {
+                             "example": {
+                                 "ids": [{
+                                     "id": 1,
+                                     "name": "Product name",
+                                     "price": 100.0,
+                                     "is_active": True
+                                 }, None],
+                                 "names": [{
+                                     "id": 1,
+                                     "name": "Product name",
+                                     "price": 100.0,
+                                     "is_active": True
+                                 }]
+                             }
+                         }
+                     }
+                 },
+             })
+async def get_products_info(lookup: ProductLookup,
+                            db: AsyncSession = Depends(get_async_read_db)):
+    return await get_products_info_view(lookup.ids, lookup.names, db)
+
+
 @router.put(
     "/update",
     status_code=status.HTTP_200_OK,
@@ -124,10 +235,10 @@ def get_product(product: ProductName, db: Session = Depends(get_db)):
             }
         },
     })
-def update_product(product: ProductCreate,
-                   current_user: User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    product = update_product_view(product.name, product.price, db)
+async def update_product(product: ProductCreate,
+                         current_user: User = Depends(get_current_active_user),
+                         db: AsyncSession = Depends(get_async_db)):
+    product = await update_product_view(product.name, product.price, db)
     return {
         "message":
         f"Product {product.name} updated successfully; new price: {product.price}"
@@ -160,16 +271,20 @@ def update_product(product: ProductCreate,
                        }
                    },
                })
-def delete_product(product: ProductName,
-                   current_user: User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    product = delete_product_view(product.name, db)
+async def delete_product(product: ProductName,
+                         current_user: User = Depends(get_current_active_user),
+                         db: AsyncSession = Depends(get_async_db)):
+    product = await delete_product_view(product.name, db)
     return {"message": f"Product {product.name} deleted successfully"}
 
 
 @router.get("/list",
             status_code=status.HTTP_200_OK,
             summary="List all products",
+            description="Products are returned in pages ordered by id. Pass "
+            "the `X-Next-Cursor` response header as `after` to fetch the next "
+            "page; the header is absent on the last page. With `stream=true` "
+            "the whole catalog is streamed as NDJSON, one product per line.",
             responses={
                 200: {
                     "description": "List of products",
@@ -189,15 +304,34 @@ def delete_product(product: ProductName,
                         }
                     }
                 },
+                304: {
+                    "description": "Catalog not modified since the ETag or "
+                    "date sent by the client"
+                },
             })
-def list_products(db: Session = Depends(get_db)):
-    products = list_products_view(db)
-    return products
+def list_products(request: Request,
+                  limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                  after: int | None = None,
+                  stream: bool = False,
+                  db: Session = Depends(get_read_db)):
+    headers = catalog_headers_view(db)
+    if catalog_not_modified_view(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+    if stream:
+        return StreamingResponse(stream_products_view(db),
+                                 media_type="application/x-ndjson",
+                                 headers=headers)
+    products, next_cursor = list_products_view(db, limit, after)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return FastJSONResponse(products, headers=headers)
 
 
 @router.get("/list_active",
             status_code=status.HTTP_200_OK,
             summary="List all active products",
+            description="Paginated and streamed the same way as `/list`.",
             responses={
                 200: {
                     "description": "List of active products",
@@ -214,10 +348,71 @@ def list_products(db: Session = Depends(get_db)):
                         }
                     }
                 },
+                304: {
+                    "description": "Catalog not modified since the ETag or "
+                    "date sent by the client"
+                },
             })
-def list_active_products(db: Session = Depends(get_db)):
-    products = list_active_products_view(db)
-    return products
+def list_active_products(request: Request,
+                         limit: int = Query(PAGE_SIZE, ge=1,
+                                            le=MAX_PAGE_SIZE),
+                         after: int | None = None,
+                         stream: bool = False,
+                         db: Session = Depends(get_read_db)):
+    headers = catalog_headers_view(db)
+    if catalog_not_modified_view(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+    if stream:
+        return StreamingResponse(
+            stream_products_view(db, active_only=True),
+            media_type="application/x-ndjson",
+            headers=headers)
+    products, next_cursor = list_active_products_view(db, limit, after)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return FastJSONResponse(products, headers=headers)
+
+
+@router.get("/cache-stats",
+            status_code=status.HTTP_200_OK,
+            summary="Catalog cache statistics",
+            responses={
+                200: {
+                    "description": "Catalog cache size and hit/miss counters",
+                    "content": {
+                        "application/json": {
+                            "example": {
+                                "size": 2,
+                                "maxsize": 10000,
+                                "ttl": 60.0,
+                                "hits": 10,
+                                "misses": 2,
+                                "pages": {
+                                    "size": 1,
+                                    "maxsize": 16,
+                                    "ttl": 60.0,
+                                    "hits": 4,
+                                    "misses": 1
+                                }
+                            }
+                        }
+                    }
+                },
+                401: {
+                    "description": "Unauthorized",
+                    "content": {
+                        "application/json": {
+                            "example": {
+                                "detail": "Not authenticated"
+                            }
+                        }
+                    }
+                },
+            })
+def catalog_cache_stats(
+        current_user: User = Depends(get_current_active_user)):
+    return catalog_cache_stats_view()
 
 
 @router.post("/add-to-cart",
@@ -247,11 +442,11 @@ def list_active_products(db: Session = Depends(get_db)):
                      }
                  }
              })
-def add_product_to_shopping_cart(
+async def add_product_to_shopping_cart(
     product: ProductID,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)):
-    add_product_to_shopping_cart_view(current_user.id, product.id, db)
+    db: AsyncSession = Depends(get_async_db)):
+    await add_product_to_shopping_cart_view(current_user.id, product.id, db)
     return {"message": "Product added to shopping cart successfully"}
 
 
@@ -282,14 +477,116 @@ def add_product_to_shopping_cart(
             }
         }
     })
-def remove_product_from_shopping_cart(
+async def remove_product_from_shopping_cart(
     product: ProductID,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)):
-    remove_product_from_shopping_cart_view(current_user.id, product.id, db)
+    db: AsyncSession = Depends(get_async_db)):
+    await remove_product_from_shopping_cart_view(current_user.id, product.id,
+                                                 db)
     return {"message": "Product removed from shopping cart successfully"}
 
 
+@router.post(
+    "/update-cart",
+    status_code=status.HTTP_200_OK,
+    summary="Apply several changes to the shopping cart",
+    description="Operations are applied in order and atomically: `add` adds "
+    "`quantity` of a product, `set` sets its quantity (0 removes it) and "
+    "`remove` removes it. If any operation fails, none is applied.",
+    responses={
+        200: {
+            "description": "Shopping cart updated successfully",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "Shopping cart updated successfully"
+                    }
+                }
+            }
+        },
+        400: {
+            "description": "Invalid operation",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Product not found"
+                    }
+                }
+            }
+        }
+    })
+async def update_shopping_cart(
+    cart: CartOperations,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)):
+    await apply_operations_to_shopping_cart_view(
+        current_user.id, [operation.dict() for operation in cart.operations],
+        db)
+    return {"message": "Shopping cart updated successfully"}
+
+
+@router.post(
+    "/checkout",
+    status_code=status.HTTP_200_OK,
+    summary="Check out the shopping cart",
+    description="Completes the open shopping cart and marks its orders paid "
+    "at the prices the products were added at. Retrying with the same "
+    "`Idempotency-Key` header returns the original checkout instead of "
+    "failing.",
+    responses={
+        200: {
+            "description": "Shopping cart checked out successfully",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "Shopping cart checked out successfully",
+                        "id": 1,
+                        "item_count": 3,
+                        "subtotal": 250.0
+                    }
+                }
+            }
+        },
+        400: {
+            "description": "Empty shopping cart",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Shopping cart is empty"
+                    }
+                }
+            }
+        },
+        404: {
+            "description": "Not found",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Shopping cart not found"
+                    }
+                }
+            }
+        },
+        409: {
+            "description": "Checked out concurrently",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Shopping cart already checked out"
+                    }
+                }
+            }
+        }
+    })
+async def checkout_shopping_cart(
+    idempotency_key: str | None = Header(None, max_length=64),
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)):
+    checkout = await checkout_shopping_cart_view(current_user.id,
+                                                 idempotency_key, db)
+    return {"message": "Shopping cart checked out successfully", **checkout}
+
+
 @router.get("/shopping-cart",
             status_code=status.HTTP_200_OK,
             summary="Open shopping cart information",
@@ -303,23 +600,55 @@ def remove_product_from_shopping_cart(
                                 "id": 1,
                                 "user_id": 1,
                                 "shopping_cart_id": 1,
-                                "product_id": 1
+                                "product_id": 1,
+                                "quantity": 2,
+                                "name": "Product name",
+                                "price": 100.0,
+                                "is_active": True
                             }]
                         }
                     }
                 },
             })
-def get_current_shopping_cart(
+async def get_current_shopping_cart(
         current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)):
-    shopping_cart = get_current_shopping_cart_view(current_user.id, db)
+        db: AsyncSession = Depends(get_async_db)):
+    shopping_cart = await get_current_shopping_cart_view(current_user.id, db)
     return shopping_cart
 
 
+@router.get("/shopping-cart/summary",
+            status_code=status.HTTP_200_OK,
+            summary="Open shopping cart summary",
+            description="Number of items and subtotal of the open shopping "
+            "cart; zero when there is none.",
+            responses={
+                200: {
+                    "description": "Shopping cart summary",
+                    "content": {
+                        "application/json": {
+                            "example": {
+                                "id": 1,
+                                "item_count": 3,
+                                "subtotal": 250.0
+                            }
+                        }
+                    }
+                },
+            })
+async def get_shopping_cart_summary(
+        current_user: User = Depends(get_current_active_user),
+        db: AsyncSession = Depends(get_async_db)):
+    return await get_shopping_cart_summary_view(current_user.id, db)
+
+
 @router.get(
     "/shopping-cart-paid",
     status_code=status.HTTP_200_OK,
     summary="paid shopping cart information",
+    description="Completed shopping carts, newest first, in pages. Pass the "
+    "`X-Next-Cursor` response header as `before` to fetch the next page; the "
+    "header is absent on the last page.",
     responses={
         200: {
             "description": "Shopping cart information",
@@ -328,15 +657,31 @@ def get_current_shopping_cart(
                     "example": [{
                         "id": 1,
                         "user_id": 1,
-                        "orders": [1, 2, 3],
-                        "completed": True
+                        "completed": True,
+                        "item_count": 2,
+                        "subtotal": 200.0,
+                        "orders": [{
+                            "id": 1,
+                            "shopping_cart_id": 1,
+                            "product_id": 1,
+                            "quantity": 2,
+                            "paid": True,
+                            "name": "Product name",
+                            "price": 100.0
+                        }]
                     }]
                 }
             }
         },
     })
-def list_shopping_cart_paid(
+async def list_shopping_cart_paid(
+        limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: int | None = None,
         current_user: User = Depends(get_current_active_user),
-        db: Session = Depends(get_db)):
-    shopping_cart = list_shopping_cart_paid_view(current_user.id, db)
-    return shopping_cart
+        db: AsyncSession = Depends(get_async_orders_read_db)):
+    shopping_carts, next_cursor = await list_shopping_cart_paid_view(
+        current_user.id, db, limit, before)
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return FastJSONResponse(shopping_carts, headers=headers)
@@ -1,44 +1,221 @@
+import csv
+import json
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from config.settings import BULK_CHUNK_SIZE, run_in_session
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import HTTPException
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from .models import Product, ShoppingCart
+from .cache import catalog_cache, page_cache
+from .models import CatalogVersion, Product, ShoppingCart
+from .responses import dumps
+from .schema import ProductCreate
+
+
+def catalog_headers_view(db: Session):
+    version, updated_at = CatalogVersion.get_version(db)
+    headers = {"ETag": f'"{version}"', "Cache-Control": "no-cache"}
+    # Last-Modified has one-second resolution, so it is only sent once the
+    # second of the last write is over. Until then a later write in the same
+    # second would not change it, and clients revalidate with the ETag.
+    if (updated_at is not None and
+            datetime.utcnow() - updated_at >= timedelta(seconds=1)):
+        headers["Last-Modified"] = format_datetime(
+            updated_at.replace(tzinfo=timezone.utc, microsecond=0),
+            usegmt=True)
+    return headers
+
+
+def catalog_not_modified_view(request: Request, headers: dict):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"] in tags or (
+            "W/" + headers["ETag"]) in tags
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is not None and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            # A "-0000" zone parses to a naive datetime; the time is UTC.
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return parsedate_to_datetime(headers["Last-Modified"]) <= since
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def create_product_view(name: str, price: int, db: AsyncSession):
+    return await run_in_session(db, Product.create_product, name, price)
+
+
+async def get_product_view(name: str, db: AsyncSession):
+    return await run_in_session(db, Product.get_product_info, name)
+
+def _decode_line(line: bytes):
+    # A line that is not UTF-8 is passed on as its UnicodeDecodeError, so it
+    # becomes an error result for that row instead of failing the request.
+    try:
+        return line.decode()
+    except UnicodeDecodeError as error:
+        return error
+
+
+async def _iter_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield _decode_line(line)
+    if buffer:
+        yield _decode_line(buffer)
+
+
+async def _iter_bulk_rows(request: Request):
+    # Yields the raw rows of a bulk request body: a JSON array, or one
+    # product per line for NDJSON and CSV (with a "name,price" header).
+    content_type = request.headers.get("content-type", "").split(";")[0]
+    if content_type == "application/x-ndjson":
+        async for line in _iter_lines(request):
+            if isinstance(line, UnicodeDecodeError):
+                yield line
+            elif line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield line
+    elif content_type == "text/csv":
+        header = None
+        async for line in _iter_lines(request):
+            if isinstance(line, UnicodeDecodeError):
+                yield line
+                continue
+            if not line.strip():
+                continue
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+            else:
+                yield dict(zip(header, values))
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400,
+                                detail="Expected a list of products")
+        for item in body:
+            yield item
+
+
+async def bulk_upsert_products_view(request: Request, db: Session):
+    results, chunk, index = [], [], 0
+    async for item in _iter_bulk_rows(request):
+        try:
+            if isinstance(item, UnicodeDecodeError):
+                raise ValidationError([ErrorWrapper(item, loc="__root__")],
+                                      ProductCreate)
+            product = ProductCreate.parse_obj(item)
+        except ValidationError as error:
+            results.append({
+                "row": index,
+                "status": "error",
+                "detail": error.errors()
+            })
+        else:
+            chunk.append({
+                "row": index,
+                "name": product.name,
+                "price": product.price
+            })
+        index += 1
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            results += await run_in_threadpool(Product.bulk_upsert_products,
+                                               chunk, db)
+            chunk = []
+    if chunk:
+        results += await run_in_threadpool(Product.bulk_upsert_products, chunk,
+                                           db)
+    return sorted(results, key=lambda result: result["row"])
+
+
+async def get_products_info_view(ids: list[int], names: list[str],
+                                 db: AsyncSession):
+    return await run_in_session(db, Product.get_products_info, ids, names)
+
+
+async def update_product_view(name: str, price: int, db: AsyncSession):
+    return await run_in_session(db, Product.update_product, name, price)
+
+async def delete_product_view(name: str, db: AsyncSession):
+    return await run_in_session(db, Product.delete_product, name)
+
+
+def list_products_view(db: Session, limit: int, after: int | None = None):
+    return Product.get_cached_products_page(db, limit, after)
+
+
+def list_active_products_view(db: Session, limit: int,
+                              after: int | None = None):
+    return Product.get_cached_products_page(db, limit, after,
+                                            active_only=True)
+
+
+def stream_products_view(db: Session, active_only: bool = False):
+    for products in Product.iter_products(db, active_only=active_only):
+        yield b"".join(dumps(product) + b"\n" for product in products)
+
+
+def catalog_cache_stats_view():
+    return {**catalog_cache.stats(), "pages": page_cache.stats()}
+
+
+async def add_product_to_shopping_cart_view(user_id: int, product_id: int,
+                                            db: AsyncSession):
+    return await run_in_session(db, ShoppingCart.add_product_to_shopping_cart,
+                                user_id, product_id)
+
+
+async def apply_operations_to_shopping_cart_view(user_id: int,
+                                                 operations: list[dict],
+                                                 db: AsyncSession):
+    return await run_in_session(
+        db, ShoppingCart.apply_operations_to_shopping_cart, user_id,
+        operations)
+
+
+async def checkout_shopping_cart_view(user_id: int, checkout_key: str | None,
+                                      db: AsyncSession):
+    return await run_in_session(db, ShoppingCart.checkout_shopping_cart,
+                                user_id, checkout_key)
+
+
+async def remove_product_from_shopping_cart_view(user_id: int, product_id: int,
+                                                 db: AsyncSession):
+    return await run_in_session(
+        db, ShoppingCart.remove_product_from_shopping_cart, user_id,
+        product_id)
 
 
-def create_product_view(name: str, price: int, db: Session):
-    return Product.create_product(name, price, db)
+async def get_current_shopping_cart_view(user_id: int, db: AsyncSession):
+    return await run_in_session(db, ShoppingCart.get_current_shopping_cart,
+                                user_id)
 
 
-def get_product_view(name: str, db: Session):
-    return Product.get_product(name, db)
+async def get_shopping_cart_summary_view(user_id: int, db: AsyncSession):
+    return await run_in_session(db, ShoppingCart.get_shopping_cart_summary,
+                                user_id)
 
-def update_product_view(name: str, price: int, db: Session):
-    return Product.update_product(name, price, db)
 
-def delete_product_view(name: str, db: Session):
-    return Product.delete_product(name, db)
-
-
-def list_products_view(db: Session):
-    return Product.get_all_products(db)
-
-
-def list_active_products_view(db: Session):
-    return Product.get_active_products(db)
-
-
-def add_product_to_shopping_cart_view(user_id: int, product_id: int,
-                                      db: Session):
-    return ShoppingCart.add_product_to_shopping_cart(user_id, product_id, db)
-
-
-def remove_product_from_shopping_cart_view(user_id: int, product_id: int,
-                                           db: Session):
-    return ShoppingCart.remove_product_from_shopping_cart(
-        user_id, product_id, db)
-
-
-def get_current_shopping_cart_view(user_id: int, db: Session):
-    return ShoppingCart.get_current_shopping_cart(user_id, db)
-
-
-def list_shopping_cart_paid_view(user_id: int, db: Session):
-    return ShoppingCart.get_list_shopping_cart_paid(user_id, db)
+async def list_shopping_cart_paid_view(user_id: int, db: AsyncSession,
+                                       limit: int, before: int | None = None):
+    return await run_in_session(db, ShoppingCart.get_list_shopping_cart_paid,
+                                user_id, limit=limit, before=before)
@@ -0,0 +1,76 @@
+# tests.py
+# This file contains the project-wide tests. They check the cold start of a
+# worker: importing main must not pull in CLI-only packages, app routers or
+# database drivers, and must stay within the import time budget. They also
+# cover the database pool statistics shared by the apps.
+
+import os
+import subprocess
+import sys
+
+from config.settings import engines, get_engine
+from fastapi.testclient import TestClient
+
+# Microseconds allowed for "import main" in a fresh interpreter; about 0.5 s
+# is measured, the rest is headroom for slower machines.
+IMPORT_TIME_BUDGET = int(os.getenv("IMPORT_TIME_BUDGET", 750000))
+
+
+def import_times(statement: str):
+    # Runs statement under "python -X importtime" and returns the
+    # cumulative import time in microseconds of every module it imported.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             statement],
+                            capture_output=True,
+                            text=True,
+                            check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_import_main_is_lazy():
+    times = import_times("import main")
+    for module in ("uvicorn", "pytest", "commands", "user.urls",
+                   "product.urls", "aiosqlite"):
+        assert module not in times, f"{module} imported by main"
+
+
+def test_import_main_time_budget():
+    times = import_times("import main")
+    assert times["main"] < IMPORT_TIME_BUDGET
+
+
+def test_pool_stats(client: TestClient):
+    assert client.get("/pool-stats").status_code == 401
+    client.post(
+        "/user/register",
+        json={
+            "username": "pool",
+            "password": "pool",
+            "email": "pool@email.com",
+        },
+    )
+    token = client.post(
+        "/user/token",
+        data={
+            "username": "pool",
+            "password": "pool"
+        },
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    # Only engines already created are reported.
+    created = set(engines)
+    response = client.get("/pool-stats", headers=headers)
+    assert response.status_code == 200
+    assert set(response.json()) == created
+    assert set(engines) == created
+    get_engine()
+    response = client.get("/pool-stats", headers=headers)
+    assert "pool" in response.json()["engine"]
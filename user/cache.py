@@ -0,0 +1,31 @@
+# cache.py
+# This file contains the principal cache of the user app. Verified tokens are
+# cached by their hash with the fields of the user they resolve to, so repeat
+# requests skip the signature check and the user query. Entries never outlive
+# the token; logout and user changes invalidate them. Invalidation is local to
+# the worker, so other workers may serve a revoked, changed or deleted user's
+# cached principal until the entry expires (PRINCIPAL_CACHE_TTL); only logout
+# reaches them at once, through the token denylist.
+
+import time
+
+from config.cache import TTLCache
+from config.settings import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+
+def cache_principal(token_hash: str, user, expires_at: float):
+    ttl = min(principal_cache.ttl, expires_at - time.time())
+    if ttl > 0:
+        principal_cache.set(token_hash, {
+            "id": user.id,
+            "username": user.username,
+            "email": user.email,
+            "is_active": user.is_active,
+            "token_version": user.token_version
+        }, ttl)
+
+
+def invalidate_user(id: int):
+    principal_cache.discard_if(lambda key, principal: principal["id"] == id)
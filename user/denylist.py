@@ -0,0 +1,108 @@
+# denylist.py
+# This file contains the in-memory denylist of logged out tokens. Each worker
+# mirrors the expired_tokens table: a Bloom filter answers "never logged out"
+# without touching the database, and a dict of token hash -> expiry confirms
+# the positives. New rows are pulled from the table periodically, re-reading
+# a window of recent rows so late commits are not missed, and expired entries
+# are purged from memory and from the table.
+
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config.settings import (DENYLIST_CAPACITY, DENYLIST_OVERLAP_SECONDS,
+                             DENYLIST_PURGE_SECONDS, DENYLIST_REFRESH_SECONDS)
+from sqlalchemy.orm import Session
+
+from .models import ExpiredToken
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = math.ceil(-capacity * math.log(error_rate) /
+                              math.log(2)**2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # key is a hex SHA-256 digest; its two halves seed double hashing.
+        first, second = int(key[:16], 16), int(key[16:32], 16) | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+class TokenDenylist:
+
+    def __init__(self, capacity: int, refresh_seconds: float,
+                 purge_seconds: float, overlap_seconds: float = 30):
+        self.capacity = capacity
+        self.refresh_seconds = refresh_seconds
+        self.purge_seconds = purge_seconds
+        self.overlap = timedelta(seconds=overlap_seconds)
+        self._entries = {}
+        self._bloom = BloomFilter(capacity)
+        self._last_created_at = None
+        self._next_refresh = 0.0
+        self._next_purge = time.monotonic() + purge_seconds
+        self._lock = threading.Lock()
+
+    def add(self, token_hash: str, expires_at: datetime):
+        with self._lock:
+            self._entries[token_hash] = expires_at
+            self._bloom.add(token_hash)
+
+    def is_denied(self, token_hash: str, db: Session):
+        if time.monotonic() >= self._next_refresh:
+            self.refresh(db)
+        if token_hash not in self._bloom:
+            return False
+        expires_at = self._entries.get(token_hash)
+        return expires_at is not None and expires_at > datetime.utcnow()
+
+    def refresh(self, db: Session):
+        # Pulls the rows added since the last refresh, including those
+        # written by other workers, and purges expired entries when due. The
+        # pull starts overlap before the newest row seen, so rows that
+        # committed after it with an earlier creation time are still read.
+        self._next_refresh = time.monotonic() + self.refresh_seconds
+        since = None
+        if self._last_created_at is not None:
+            since = self._last_created_at - self.overlap
+        for row in ExpiredToken.get_expired_tokens_since(since, db):
+            self.add(row.token_hash, row.expires_at)
+            if (self._last_created_at is None
+                    or row.created_at > self._last_created_at):
+                self._last_created_at = row.created_at
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_seconds
+            ExpiredToken.purge_expired_tokens(db)
+            self.purge()
+
+    def purge(self):
+        # A Bloom filter cannot forget keys, so it is rebuilt from the
+        # entries that are still valid.
+        now = datetime.utcnow()
+        with self._lock:
+            self._entries = {
+                token_hash: expires_at
+                for token_hash, expires_at in self._entries.items()
+                if expires_at > now
+            }
+            self._bloom = BloomFilter(
+                max(self.capacity, 2 * len(self._entries)))
+            for token_hash in self._entries:
+                self._bloom.add(token_hash)
+
+
+token_denylist = TokenDenylist(DENYLIST_CAPACITY, DENYLIST_REFRESH_SECONDS,
+                               DENYLIST_PURGE_SECONDS,
+                               DENYLIST_OVERLAP_SECONDS)
@@ -1,75 +1,197 @@
+import hashlib
+from datetime import datetime
+
 from config.settings import Base
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, validates
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, Integer, String, insert
+from sqlalchemy.exc import IntegrityError
+
+from .cache import invalidate_user
         
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     email = Column(String, unique=True, index=True)
+    # Lower-cased copies so case-insensitive lookups use an index.
+    username_key = Column(String, unique=True, index=True)
+    email_key = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+    # Embedded in issued tokens; bumping it revokes every token of the user.
+    token_version = Column(Integer, nullable=False, default=0,
+                           server_default="0")
     
+    @validates("username")
+    def validate_username(self, key, username):
+        self.username_key = username.lower()
+        return username
+
+    @validates("email")
+    def validate_email(self, key, email):
+        self.email_key = email.lower()
+        return email
+
     def __repr__(self):
         return f"User(id={self.id}, username={self.username}, email={self.email}, is_active={self.is_active})"
     
     @staticmethod
     def get_user(username: str, db: Session):
-        user = db.query(User).filter(User.username.ilike(username)).first()
+        user = db.query(User).filter(
+            User.username_key == username.lower()).first()
         return user
     
+    @staticmethod
+    def get_user_by_id(id: int, db: Session):
+        return db.get(User, id)
+
+    @staticmethod
+    def duplicate_detail(error: IntegrityError):
+        # Maps a unique violation on the normalized keys to the error message
+        # of the registration endpoint, by the violated columns: Postgres
+        # reports the index name, SQLite lists "table.column" in the message.
+        if User.duplicate_columns(error) & {"email", "email_key"}:
+            return "Email already exists"
+        return "User already exists"
+
+    @staticmethod
+    def duplicate_columns(error: IntegrityError):
+        orig = error.orig
+        # psycopg2 exposes diag; asyncpg errors are chained as the cause.
+        constraint = getattr(getattr(orig, "diag", None), "constraint_name",
+                             None) or getattr(orig.__cause__,
+                                              "constraint_name", None)
+        if constraint is not None:
+            return {
+                column.name
+                for index in User.__table__.indexes
+                if index.name == constraint for column in index.columns
+            }
+        message = str(orig)
+        prefix = "UNIQUE constraint failed: "
+        if not message.startswith(prefix):
+            return set()
+        return {
+            column.strip().split(".")[-1]
+            for column in message[len(prefix):].split(",")
+        }
+
     @staticmethod
     def create_user(user: "User", db: Session):
-        if db.query(User).filter(User.username.ilike(user.username)).first():
-            raise HTTPException(status_code=400, detail="User already exists")
-        if db.query(User).filter(User.email.ilike(user.email)).first():
-            raise HTTPException(status_code=400, detail="Email already exists")
+        # A single INSERT; the unique username_key and email_key constraints
+        # reject duplicates, including concurrent signups.
         db.add(user)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError as error:
+            db.rollback()
+            raise HTTPException(status_code=400,
+                                detail=User.duplicate_detail(error))
         db.refresh(user)
         return user
+
+    @staticmethod
+    def bulk_import(rows: list[dict], db: Session):
+        # rows are dicts with "username", "email", "hashed_password" and an
+        # optional "is_active". The chunk is inserted with one executemany
+        # statement; if a constraint rejects it, the rows are inserted one
+        # by one in savepoints so duplicates are reported and skipped.
+        table = User.__table__
+        values = [{
+            "username": row["username"],
+            "email": row["email"],
+            "username_key": row["username"].lower(),
+            "email_key": row["email"].lower(),
+            "hashed_password": row["hashed_password"],
+            "is_active": row.get("is_active", True),
+            "token_version": 0
+        } for row in rows]
+        results = [{"username": row["username"], "status": "created"}
+                   for row in rows]
+        try:
+            with db.begin_nested():
+                db.execute(insert(table), values)
+        except IntegrityError:
+            for value, result in zip(values, results):
+                try:
+                    with db.begin_nested():
+                        db.execute(insert(table).values(**value))
+                except IntegrityError as error:
+                    result["status"] = "skipped"
+                    result["detail"] = User.duplicate_detail(error)
+        db.commit()
+        return results
     
     @staticmethod
     def delete_user(id: int, db: Session):
         user = db.query(User).filter(User.id == id).first()
         db.delete(user)
         db.commit()
+        invalidate_user(id)
         return user
     
     @staticmethod
     def update_user(id: int, user: BaseModel, db: Session):
-        user = db.query(User).filter(User.id == id).first()
-        for key, value in user.dict().items():
-            setattr(user, key, value)
+        db_user = db.query(User).filter(User.id == id).first()
+        values = user.dict()
+        for key, value in values.items():
+            setattr(db_user, key, value)
+        if {"username", "hashed_password", "is_active"} & values.keys():
+            # Credentials changed: tokens issued before are no longer valid.
+            db_user.token_version = User.token_version + 1
         db.commit()
-        db.refresh(user)
-        return user
+        db.refresh(db_user)
+        invalidate_user(id)
+        return db_user
     
+    @staticmethod
+    def revoke_tokens(id: int, db: Session):
+        db.query(User).filter(User.id == id).update(
+            {User.token_version: User.token_version + 1},
+            synchronize_session=False)
+        db.commit()
+        invalidate_user(id)
+
     @staticmethod
     def get_users(db: Session):
         users = db.query(User).all()
         return users
 
 class ExpiredToken(Base):
+    # Logged out tokens, stored as SHA-256 hashes until their own expiry.
     __tablename__ = "expired_tokens"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = Column(Integer, primary_key=True, index=True)
-    token = Column(String, unique=True, index=True)
+    token_hash = Column(String(64), unique=True, index=True)
+    expires_at = Column(DateTime, index=True)
+    # Workers pull new rows by creation time rather than id: ids are handed
+    # out at insert, so a row may commit after one with a higher id.
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        index=True)
     
     def __repr__(self):
-        return f"ExpiredToken(id={self.id}, token={self.token})"
+        return f"ExpiredToken(id={self.id}, token_hash={self.token_hash}, expires_at={self.expires_at})"
+    
+    @staticmethod
+    def hash_token(token: str):
+        return hashlib.sha256(token.encode()).hexdigest()
     
     @staticmethod
     def get_expired_token(token: str, db: Session):
-        expired_token = db.query(ExpiredToken).filter(ExpiredToken.token == token).first()
+        expired_token = db.query(ExpiredToken).filter(
+            ExpiredToken.token_hash == ExpiredToken.hash_token(token)).first()
         return expired_token
     
     @staticmethod
-    def add_token(token: str, db: Session):
-        if db.query(ExpiredToken).filter(ExpiredToken.token == token).first():
+    def add_token(token: str, expires_at: datetime, db: Session):
+        token_hash = ExpiredToken.hash_token(token)
+        if db.query(ExpiredToken).filter(
+                ExpiredToken.token_hash == token_hash).first():
             raise HTTPException(status_code=400, detail="Token already exists")
-        expired_token = ExpiredToken(token=token)
+        expired_token = ExpiredToken(token_hash=token_hash,
+                                     expires_at=expires_at)
         db.add(expired_token)
         db.commit()
         db.refresh(expired_token)
@@ -78,4 +200,23 @@ class ExpiredToken(Base):
     @staticmethod
     def get_expired_tokens(db: Session):
         expired_tokens = db.query(ExpiredToken).all()
-        return expired_tokens
\ No newline at end of file
+        return expired_tokens
+    
+    @staticmethod
+    def get_expired_tokens_since(since: datetime | None, db: Session):
+        # Entries created at or after since (all when None) that have not
+        # expired yet.
+        query = db.query(ExpiredToken.token_hash, ExpiredToken.expires_at,
+                         ExpiredToken.created_at).filter(
+                             ExpiredToken.expires_at > datetime.utcnow())
+        if since is not None:
+            query = query.filter(ExpiredToken.created_at >= since)
+        return query.all()
+    
+    @staticmethod
+    def purge_expired_tokens(db: Session):
+        deleted = db.query(ExpiredToken).filter(
+            ExpiredToken.expires_at <= datetime.utcnow()).delete(
+                synchronize_session=False)
+        db.commit()
+        return deleted
@@ -3,12 +3,18 @@ from pydantic import BaseModel
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
     
 class AccessToken(BaseModel):
     access_token: str
 
+class RefreshToken(BaseModel):
+    refresh_token: str
+
 class TokenData(BaseModel):
     username: str | None = None
+    user_id: int | None = None
+    version: int = 0
     
     class Config:
         orm_mode = True
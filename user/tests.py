@@ -1,8 +1,19 @@
 # tests.py
 # This file contains the tests for user app.
 
+import asyncio
+from datetime import datetime, timedelta
+from fastapi.exceptions import HTTPException
 from fastapi.testclient import TestClient
+import pytest
 import time
+from jose import jwt
+from sqlalchemy.exc import IntegrityError
+
+from user.denylist import TokenDenylist
+from config.settings import get_db
+from user.models import ExpiredToken, User
+from user.views import PasswordHasher
 
 def test_create_user(client: TestClient):
     response = client.post(
@@ -17,7 +28,71 @@ def test_create_user(client: TestClient):
     assert response.json() == {
         "message": "User test registered successfully"
     }
+
+
+def test_create_user_case_insensitive_duplicate(client: TestClient):
+    response = client.post(
+        "/user/register",
+        json={
+            "username": "TEST",
+            "password": "test",
+            "email": "other@email.com",
+        },
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "User already exists"}
+    response = client.post(
+        "/user/register",
+        json={
+            "username": "other",
+            "password": "test",
+            "email": "Test@Email.com",
+        },
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Email already exists"}
+
+
+def test_duplicate_detail():
+    # The violated column decides the message, not words in the values.
+    class Diag:
+        constraint_name = "ix_users_username_key"
+
+    class PostgresError(Exception):
+        diag = Diag()
+
+    error = IntegrityError(
+        "INSERT", {}, PostgresError('duplicate key value violates unique '
+                                    'constraint "ix_users_username_key" '
+                                    'DETAIL: Key (username_key)=(myemail)'))
+    assert User.duplicate_detail(error) == "User already exists"
+    Diag.constraint_name = "ix_users_email_key"
+    assert User.duplicate_detail(error) == "Email already exists"
+    error = IntegrityError(
+        "INSERT", {},
+        Exception("UNIQUE constraint failed: users.email_key"))
+    assert User.duplicate_detail(error) == "Email already exists"
+
         
+def test_bulk_import_users(client: TestClient):
+    db = next(client.app.dependency_overrides[get_db]())
+    results = User.bulk_import([
+        {"username": "legacy1", "email": "legacy1@test.com",
+         "hashed_password": "hash"},
+        {"username": "TEST", "email": "legacy2@test.com",
+         "hashed_password": "hash"},
+        {"username": "legacy3", "email": "Test@Email.com",
+         "hashed_password": "hash"},
+    ], db)
+    assert [result["status"] for result in results] == [
+        "created", "skipped", "skipped"]
+    assert results[1]["detail"] == "User already exists"
+    assert results[2]["detail"] == "Email already exists"
+    assert User.get_user("LEGACY1", db).email == "legacy1@test.com"
+    User.delete_user(User.get_user("legacy1", db).id, db)
+    db.close()
+
+
 def test_login(client: TestClient):
     response = client.post(
         "/user/token",
@@ -27,6 +102,57 @@ def test_login(client: TestClient):
     assert "access_token" in response.json()
     assert "token_type" in response.json()
     assert response.json()["token_type"] == "bearer"
+
+
+def test_principal_cache(client: TestClient):
+    token = client.post(
+        "/user/token",
+        data={"username": "test", "password": "test"},
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.get("/product/shopping-cart/summary", headers=headers)
+    before = client.get("/user/cache-stats", headers=headers).json()
+    response = client.get("/product/shopping-cart/summary", headers=headers)
+    assert response.status_code == 200
+    after = client.get("/user/cache-stats", headers=headers).json()
+    # The summary and the second stats request both hit the cache.
+    assert after["hits"] == before["hits"] + 2
+
+
+def test_refresh_token(client: TestClient):
+    tokens = client.post(
+        "/user/token",
+        data={"username": "test", "password": "test"},
+    ).json()
+    response = client.post(
+        "/user/token/refresh",
+        json={"refresh_token": tokens["refresh_token"]},
+    )
+    assert response.status_code == 200
+    refreshed = response.json()
+    assert refreshed["refresh_token"] != tokens["refresh_token"]
+    response = client.get(
+        "/product/shopping-cart/summary",
+        headers={"Authorization": f"Bearer {refreshed['access_token']}"},
+    )
+    assert response.status_code == 200
+    # The rotated refresh token is revoked
+    response = client.post(
+        "/user/token/refresh",
+        json={"refresh_token": tokens["refresh_token"]},
+    )
+    assert response.status_code == 401
+    # Access and refresh tokens are not interchangeable
+    response = client.post(
+        "/user/token/refresh",
+        json={"refresh_token": refreshed["access_token"]},
+    )
+    assert response.status_code == 401
+    response = client.get(
+        "/product/shopping-cart/summary",
+        headers={"Authorization": f"Bearer {refreshed['refresh_token']}"},
+    )
+    assert response.status_code == 401
     
 def test_logout(client: TestClient):
     token = client.post(
@@ -42,7 +168,33 @@ def test_logout(client: TestClient):
     assert response.json() == {
         "message": "Logged out successfully"
     }
+    response = client.post(
+        "/user/logout",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 401
     
+def test_logout_all(client: TestClient):
+    # Sleep for 1 second so the token differs from the logged out one
+    time.sleep(1)
+    tokens = client.post(
+        "/user/token",
+        data={"username": "test", "password": "test"},
+    ).json()
+    claims = jwt.get_unverified_claims(tokens["access_token"])
+    assert claims["uid"] == 1
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    response = client.post("/user/logout-all", headers=headers)
+    assert response.status_code == 200
+    response = client.get("/product/shopping-cart/summary", headers=headers)
+    assert response.status_code == 401
+    response = client.post(
+        "/user/token/refresh",
+        json={"refresh_token": tokens["refresh_token"]},
+    )
+    assert response.status_code == 401
+
+
 def test_delete_user(client: TestClient):
     # Sleep for 1 second to avoid duplicate token error
     time.sleep(1)
@@ -58,4 +210,55 @@ def test_delete_user(client: TestClient):
     assert response.json() == {
         "message": "User test deleted successfully"
     }
-    
\ No newline at end of file
+    response = client.get(
+        "/product/shopping-cart/summary",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 401
+
+
+def test_token_denylist_purge():
+    denylist = TokenDenylist(capacity=100, refresh_seconds=60,
+                             purge_seconds=60)
+    expired = ExpiredToken.hash_token("expired")
+    valid = ExpiredToken.hash_token("valid")
+    denylist.add(expired, datetime.utcnow() - timedelta(seconds=1))
+    denylist.add(valid, datetime.utcnow() + timedelta(minutes=5))
+    denylist.purge()
+    assert expired not in denylist._entries
+    assert valid in denylist._bloom
+    assert ExpiredToken.hash_token("other") not in denylist._bloom
+
+
+def test_token_denylist_late_commit(client: TestClient):
+    # A logout inserted before the newest row already pulled (lower id and
+    # earlier creation time), but committed after the pull, is still picked
+    # up by the next refresh.
+    db = next(client.app.dependency_overrides[get_db]())
+    denylist = TokenDenylist(capacity=100, refresh_seconds=60,
+                             purge_seconds=3600, overlap_seconds=30)
+    expires_at = datetime.utcnow() + timedelta(minutes=5)
+    now = datetime.utcnow()
+    db.add(ExpiredToken(id=900001,
+                        token_hash=ExpiredToken.hash_token("newer"),
+                        expires_at=expires_at, created_at=now))
+    db.commit()
+    denylist.refresh(db)
+    late = ExpiredToken.hash_token("late")
+    db.add(ExpiredToken(id=900000, token_hash=late, expires_at=expires_at,
+                        created_at=now - timedelta(seconds=5)))
+    db.commit()
+    denylist.refresh(db)
+    assert denylist.is_denied(late, db)
+    db.close()
+
+
+def test_password_hasher_backpressure():
+    hasher = PasswordHasher(workers=1, max_pending=0)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(hasher.hash("password"))
+    assert error.value.status_code == 503
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    hashed_password = asyncio.run(hasher.hash("password"))
+    assert asyncio.run(hasher.verify("password", hashed_password))
+    assert hasher.pending == 0
@@ -1,15 +1,18 @@
 import re
-from datetime import timedelta
 
-from config.settings import ACCESS_TOKEN_EXPIRE_MINUTES, get_db
+from config.settings import (ALGORITHM, SECRET_KEY, get_async_db,
+                             run_in_session)
 from fastapi import APIRouter, Depends, Request, status
 from fastapi.exceptions import HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from jose import JWTError, jwt
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from .cache import principal_cache
+from .denylist import token_denylist
 from .models import ExpiredToken, User
-from .schema import Token, UserRegister
-from .views import Authenticate, get_current_active_user
+from .schema import RefreshToken, Token, UserRegister
+from .views import Authenticate, get_current_active_user, revoke_token
 
 router = APIRouter(
     prefix="/user",
@@ -48,7 +51,8 @@ router = APIRouter(
       
     }
     )
-def register(user: UserRegister, db: Session = Depends(get_db)):
+async def register(user: UserRegister,
+                   db: AsyncSession = Depends(get_async_db)):
     # Check email is valid
     regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
     if not re.fullmatch(regex, user.email):
@@ -56,10 +60,10 @@ def register(user: UserRegister, db: Session = Depends(get_db)):
     user = User(
         username=user.username,
         email=user.email,
-        hashed_password=Authenticate.get_password_hash(user.password),
+        hashed_password=await Authenticate.get_password_hash(user.password),
         is_active=True,
     )
-    user = User.create_user(user, db)
+    user = await run_in_session(db, User.create_user, user)
     return {"message": f"User {user.username} registered successfully"}
 
 
@@ -101,9 +105,9 @@ def register(user: UserRegister, db: Session = Depends(get_db)):
         },
     },
     )
-def delete(current_user: User = Depends(get_current_active_user),
-           db: Session = Depends(get_db)):
-    User.delete_user(current_user.id, db)
+async def delete(current_user: User = Depends(get_current_active_user),
+                 db: AsyncSession = Depends(get_async_db)):
+    await run_in_session(db, User.delete_user, current_user.id)
     return {"message": f"User {current_user.username} deleted successfully"}
 
 
@@ -128,6 +132,7 @@ def delete(current_user: User = Depends(get_current_active_user),
                 "application/json": {
                     "example": {
                         "access_token": "access_token",
+                        "refresh_token": "refresh_token",
                         "token_type": "bearer"
                     }
                 }
@@ -137,13 +142,45 @@ def delete(current_user: User = Depends(get_current_active_user),
     )
 async def login_for_access_token(
         form_data: OAuth2PasswordRequestForm = Depends(),
-        db: Session = Depends(get_db)):
+        db: AsyncSession = Depends(get_async_db)):
     auth = Authenticate(form_data.username, form_data.password, db)
-    user = auth.authenticate()
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = Authenticate.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires)
-    return {"access_token": access_token, "token_type": "bearer"}
+    user = await auth.authenticate()
+    return Authenticate.create_tokens(user)
+
+
+@router.post(
+    "/token/refresh",
+    response_model=Token,
+    summary="Refresh access token",
+    responses={
+        401: {
+            "description": "Unauthorized",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Could not validate credentials"
+                    }
+                }
+            }
+        },
+        200: {
+            "description": "New access token and rotated refresh token",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "access_token": "access_token",
+                        "refresh_token": "refresh_token",
+                        "token_type": "bearer"
+                    }
+                }
+            }
+        },
+    },
+    )
+async def refresh_access_token(body: RefreshToken,
+                               db: AsyncSession = Depends(get_async_db)):
+    return await run_in_session(db, Authenticate.refresh_tokens,
+                                body.refresh_token)
 
 
 @router.post(
@@ -173,9 +210,93 @@ async def login_for_access_token(
         },
     },               
     )
-def logout(current_user: User = Depends(get_current_active_user),
-           db: Session = Depends(get_db),
-           request: Request = None):
+async def logout(current_user: User = Depends(get_current_active_user),
+                 db: AsyncSession = Depends(get_async_db),
+                 request: Request = None,
+                 body: RefreshToken | None = None):
     token = request.headers["Authorization"].split(" ")[1]
-    ExpiredToken.add_token(token, db)
+    await run_in_session(db, revoke_token, token)
+    if body is not None:
+        # Also revoke the refresh token, so the session cannot be renewed.
+        # Tokens of another user or already revoked ones are ignored.
+        try:
+            payload = jwt.decode(body.refresh_token, SECRET_KEY,
+                                 algorithms=[ALGORITHM])
+        except JWTError:
+            payload = {}
+        if (payload.get("type") == "refresh"
+                and payload.get("sub") == current_user.username
+                and not await run_in_session(
+                    db, token_denylist.is_denied,
+                    ExpiredToken.hash_token(body.refresh_token))):
+            await run_in_session(db, revoke_token, body.refresh_token)
     return {"message": "Logged out successfully"}
+
+
+@router.post(
+    "/logout-all",
+    status_code=status.HTTP_200_OK,
+    summary="Logout user from every session",
+    responses={
+        401: {
+            "description": "Unauthorized",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Not authenticated"
+                    }
+                }
+            }
+        },
+        200: {
+            "description": "Revoked every access and refresh token of the user",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "Logged out of all sessions"
+                    }
+                }
+            }
+        },
+    },
+    )
+async def logout_all(current_user: User = Depends(get_current_active_user),
+                     db: AsyncSession = Depends(get_async_db)):
+    await run_in_session(db, User.revoke_tokens, current_user.id)
+    return {"message": "Logged out of all sessions"}
+
+
+@router.get(
+    "/cache-stats",
+    status_code=status.HTTP_200_OK,
+    summary="Principal cache statistics",
+    responses={
+        200: {
+            "description": "Principal cache size and hit/miss counters",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "size": 2,
+                        "maxsize": 10000,
+                        "ttl": 60.0,
+                        "hits": 10,
+                        "misses": 2
+                    }
+                }
+            }
+        },
+        401: {
+            "description": "Unauthorized",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Not authenticated"
+                    }
+                }
+            }
+        },
+    },
+    )
+def principal_cache_stats(
+        current_user: User = Depends(get_current_active_user)):
+    return principal_cache.stats()
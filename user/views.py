@@ -1,14 +1,26 @@
 # views.py
 
-from .models import User, ExpiredToken
+import asyncio
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import cache_principal, principal_cache
+from .denylist import token_denylist
+from .models import ExpiredToken, User
 from .schema import Token, TokenData
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from config.settings import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, get_db
+from config.settings import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from config.settings import get_async_db, run_in_session
+from config.settings import PASSWORD_HASH_QUEUE, PASSWORD_HASH_WORKERS
+from config.settings import REFRESH_TOKEN_EXPIRE_DAYS
+from sqlalchemy.exc import IntegrityError
 
 router = APIRouter(
     prefix="/user",
@@ -18,6 +30,43 @@ router = APIRouter(
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+
+class PasswordHasher:
+    # Runs bcrypt on its own bounded thread pool, awaited from async handlers,
+    # so hashing never blocks the event loop or takes every threadpool slot.
+    # Once max_pending hashes are running or queued, new ones are refused.
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+
+    async def _run(self, function, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many authentication requests",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, function, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def hash(self, password: str):
+        return await self._run(pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        return await self._run(pwd_context.verify, password, hashed_password)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="user/token")
 
 class Authenticate:
@@ -26,15 +75,15 @@ class Authenticate:
         self.password = password
         self.db = db
 
-    def authenticate(self):
-        user = User.get_user(self.username, self.db)
+    async def authenticate(self):
+        user = await run_in_session(self.db, User.get_user, self.username)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"User {self.username} not found",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        if not self.verify_password(user.hashed_password):
+        if not await self.verify_password(user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Incorrect password",
@@ -42,12 +91,12 @@ class Authenticate:
             )
         return user
     
-    def verify_password(self, password):
-        return pwd_context.verify(self.password, password)
+    async def verify_password(self, password):
+        return await password_hasher.verify(self.password, password)
     
     @staticmethod
-    def get_password_hash(password):
-        return pwd_context.hash(password)
+    async def get_password_hash(password):
+        return await password_hasher.hash(password)
     
     @staticmethod
     def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -60,25 +109,121 @@ class Authenticate:
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
         return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    @staticmethod
+    def create_refresh_token(data: dict):
+        # Long-lived token only accepted by /user/token/refresh. The random
+        # jti makes every rotation produce a distinct token.
+        to_encode = data.copy()
+        to_encode.update({
+            "exp": datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+            "type": "refresh",
+            "jti": secrets.token_urlsafe(16),
+        })
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+    @staticmethod
+    def claims(user: User):
+        # uid lets the principal be loaded by primary key and ver is checked
+        # against User.token_version, so bumping it revokes the token.
+        return {
+            "sub": user.username,
+            "uid": user.id,
+            "ver": user.token_version
+        }
+
+    @staticmethod
+    def get_principal(payload: dict, db: Session):
+        token_data = TokenData(username=payload.get("sub"),
+                               user_id=payload.get("uid"),
+                               version=payload.get("ver", 0))
+        if token_data.user_id is not None:
+            user = User.get_user_by_id(token_data.user_id, db)
+        elif token_data.username is not None:
+            # Tokens issued before uid was added to the claims.
+            user = User.get_user(token_data.username, db)
+        else:
+            return None
+        if user is None or user.token_version != token_data.version:
+            return None
+        return user
+
+    @staticmethod
+    def create_tokens(user: User):
+        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        claims = Authenticate.claims(user)
+        access_token = Authenticate.create_access_token(
+            data=claims, expires_delta=access_token_expires)
+        refresh_token = Authenticate.create_refresh_token(data=claims)
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "token_type": "bearer"
+        }
+
+    @staticmethod
+    def refresh_tokens(refresh_token: str, db: Session):
+        # Rotates a refresh token: it is revoked and a new access and refresh
+        # token pair is issued, without any password check. A revoked refresh
+        # token, including one raced by a concurrent refresh, is rejected.
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        try:
+            payload = jwt.decode(refresh_token, SECRET_KEY,
+                                 algorithms=[ALGORITHM])
+        except JWTError:
+            raise credentials_exception
+        if payload.get("type") != "refresh":
+            raise credentials_exception
+        if token_denylist.is_denied(ExpiredToken.hash_token(refresh_token),
+                                    db):
+            raise credentials_exception
+        user = Authenticate.get_principal(payload, db)
+        if user is None or not user.is_active:
+            raise credentials_exception
+        try:
+            revoke_token(refresh_token, db)
+        except (HTTPException, IntegrityError):
+            db.rollback()
+            raise credentials_exception
+        return Authenticate.create_tokens(user)
+
+
+def revoke_token(token: str, db: Session):
+    # Records the token in expired_tokens until its own expiry and applies it
+    # to this worker's denylist and principal cache right away.
+    expires_at = datetime.utcfromtimestamp(
+        jwt.get_unverified_claims(token)["exp"])
+    token_hash = ExpiredToken.hash_token(token)
+    ExpiredToken.add_token(token, expires_at, db)
+    token_denylist.add(token_hash, expires_at)
+    principal_cache.pop(token_hash)
+
+async def get_current_user(token: str = Depends(oauth2_scheme),
+                           db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    if ExpiredToken.get_expired_token(token, db):
+    token_hash = ExpiredToken.hash_token(token)
+    if await run_in_session(db, token_denylist.is_denied, token_hash):
         raise credentials_exception
+    principal = principal_cache.get(token_hash)
+    if principal is not None:
+        return User(**principal)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = User.get_user(username=token_data.username, db=db)
+    if payload.get("type") == "refresh":
+        raise credentials_exception
+    user = await run_in_session(db, Authenticate.get_principal, payload)
     if user is None:
         raise credentials_exception
+    cache_principal(token_hash, user, payload["exp"])
     return user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):